@@ -2,29 +2,64 @@ import os
 import sys
 
 from flask import Flask
-from flask import request, current_app, Blueprint, send_from_directory, render_template, after_this_request, jsonify, g, abort
+from flask import request, current_app, Blueprint, send_from_directory, render_template, after_this_request, jsonify, g, abort, stream_with_context
 
 import redis
 
 import gzip
 import functools
+from io import BytesIO
 import argparse
 
 from geo import query_circle, query_quadrangle
-from geo import quadrangle_for_sequence_number
+from geo import query_shards, query_shards_circle
+from geo import query_partitions
+from geo import quadrangle_for_sequence_number, sequence_number_array_for_bounds, adaptive_covering
 from geo import is_valid_datetime_partition
 
 from interpolate import loader, AQIInterpolator, aqiFromPM
-from ingest import datetime_score
+from members import datetime_score, decode_member
+from cache import PartitionCache
 from datetime import datetime
+import json
 from time import time
 
 def get_redis():
    if 'redis' not in g:
-      r = redis.Redis(host=current_app.config['REDIS_HOST'],port=int(current_app.config['REDIS_PORT']),password=current_app.config.get('REDIS_PASSWORD'))
+      if current_app.config.get('REDIS_CLUSTER'):
+         r = redis.RedisCluster(host=current_app.config['REDIS_HOST'],port=int(current_app.config['REDIS_PORT']),password=current_app.config.get('REDIS_PASSWORD'))
+      else:
+         r = redis.Redis(host=current_app.config['REDIS_HOST'],port=int(current_app.config['REDIS_PORT']),password=current_app.config.get('REDIS_PASSWORD'))
       g.redis = r
    return g.redis
 
+def partition_quadrangle(client,key,nw,se):
+   shard_size = current_app.config.get('SHARD_SIZE')
+   if shard_size is None:
+      return query_quadrangle(client,key,nw,se)
+   return query_shards(client,key,float(shard_size),nw,se)
+
+def partition_circle(client,key,center,radius,unit='km'):
+   shard_size = current_app.config.get('SHARD_SIZE')
+   if shard_size is None:
+      return query_circle(client,key,center,radius,unit=unit)
+   return query_shards_circle(client,key,float(shard_size),center,radius,unit=unit)
+
+def cached(partition,query,compute):
+   """
+   Returns a JSON response of the result of a query of a partition that is
+   computed (as bytes) by the compute function unless it is cached (see
+   cache.PartitionCache).
+   """
+   cache = current_app.extensions.get('aqi_cache')
+   if cache is None:
+      data, hit = compute(), False
+   else:
+      data, hit = cache.get(get_redis(),partition,query,compute)
+   response = current_app.response_class(data,mimetype='application/json')
+   response.headers['X-Cache'] = 'hit' if hit else 'miss'
+   return response
+
 def gzipped(f):
    @functools.wraps(f)
    def view_func(*args, **kwargs):
@@ -70,9 +105,16 @@ def index():
 @aqi.route('/api/load')
 def load():
    urls = request.args.getlist('url')
+   # only remote partitions can be loaded (not files on the server)
+   for url in urls:
+      if not url.startswith(('http://','https://')):
+         return jsonify({'error':'Only http and https urls can be loaded: '+url}),400
    start = datetime.now()
    bayarea = [38.41646632263371,-124.02669995117195,36.98663820370443,-120.12930004882817]
-   interpolator = loader(bayarea,urls)
+   try:
+      interpolator = loader(bayarea,urls)
+   except ValueError as e:
+      return jsonify({'error':str(e)}),400
    loaded_at = datetime.now()
    grid = interpolator.generate_grid(method='linear')
    interpolated_at = datetime.now()
@@ -109,20 +151,21 @@ def quadrandle(size,sequence_number,datetime_partition):
 
    nw, se = quadrangle_for_sequence_number(size,sequence_number)
 
-   key = current_app.config['KEY_PREFIX'] + datetime_partition + 'PT' + str(partition) + 'M'
+   partition_set = datetime_partition + 'PT' + str(partition) + 'M'
+   key = current_app.config['KEY_PREFIX'] + partition_set
 
-   result = query_quadrangle(client,key,nw,se)
+   def query():
+      result = partition_quadrangle(client,key,nw,se)
 
-   data = []
-   for key, pos in result:
+      data = []
+      for member, pos in result:
 
-      sensor = key.decode('utf-8').split(',')
-      id, minute = sensor[0].split('@')
-      minute = int(minute)
-      readings = list(map(float,sensor[1:]))
-      data.append([id,minute] + [pos[0],pos[1]] + readings)
+         id, minute, readings = decode_member(member)
+         data.append([id,minute] + [pos[0],pos[1]] + readings)
 
-   return jsonify(data)
+      return jsonify(data).get_data()
+
+   return cached(partition_set,'q/{size}/n/{sequence_number}'.format(size=size,sequence_number=sequence_number),query)
 
 @aqi.route('/api/interpolate',methods=['POST'])
 @gzipped
@@ -160,15 +203,12 @@ def interpolate_region():
 
    key = current_app.config['KEY_PREFIX'] + datetime_partition + 'PT' + str(partition) + 'M'
 
-   result = query_quadrangle(client,key,nw,se)
+   result = partition_quadrangle(client,key,nw,se)
 
    data = []
    for key, pos in result:
 
-      sensor = key.decode('utf-8').split(',')
-      id, minute = sensor[0].split('@')
-      minute = int(minute)
-      readings = list(map(float,sensor[1:]))
+      id, minute, readings = decode_member(key)
       data.append([id,minute] + [pos[0],pos[1]] + readings)
 
    return jsonify(data)
@@ -209,25 +249,27 @@ def partition(partition_set):
       selat is not None and \
       selon is not None:
 
-      result = query_quadrangle(client,key,(nwlat,nwlon),(selat,selon))
+      cache_query = 'quadrangle/{},{},{},{}'.format(nwlat,nwlon,selat,selon)
+      search = lambda : partition_quadrangle(client,key,(nwlat,nwlon),(selat,selon))
 
    else:
 
       if None in [lat,lon,radius]:
          return jsonify({'error': 'The bounds of the circle are not completely specified. All of lat, lon, and radius must be specified.'}), 400
 
-      result = query_circle(client,key,(lat,lon),radius,unit=unit)
+      cache_query = 'circle/{},{},{}{}'.format(lat,lon,radius,unit)
+      search = lambda : partition_circle(client,key,(lat,lon),radius,unit=unit)
 
-   data = []
-   for key, pos in result:
+   def query():
+      data = []
+      for member, pos in search():
 
-      sensor = key.decode('utf-8').split(',')
-      id, minute = sensor[0].split('@')
-      minute = int(minute)
-      readings = list(map(float,sensor[1:]))
-      data.append([id,minute] + [pos[0],pos[1]] + readings)
+         id, minute, readings = decode_member(member)
+         data.append([id,minute] + [pos[0],pos[1]] + readings)
 
-   return jsonify(data)
+      return jsonify(data).get_data()
+
+   return cached(partition_set,cache_query,query)
 
 @aqi.route('/api/partition/<partition_set>/interpolate')
 def interpolate(partition_set):
@@ -261,36 +303,38 @@ def interpolate(partition_set):
 
    key = current_app.config['KEY_PREFIX'] + partition_set
 
-   result = query_quadrangle(client,key,(interpolation_bounds[0],interpolation_bounds[1]),(interpolation_bounds[2],interpolation_bounds[3]))
+   def query():
+      result = partition_quadrangle(client,key,(interpolation_bounds[0],interpolation_bounds[1]),(interpolation_bounds[2],interpolation_bounds[3]))
 
-   start = time();
-   count = 0
+      start = time();
+      count = 0
 
-   interpolator = AQIInterpolator(interpolation_bounds,resolution=resolution)
-   for key, pos in result:
-      sensor = key.decode('utf-8').split(',')
-      # pm_0 at position 1
-      pm = float(sensor[1+index])
-      interpolator.add(pos[0],pos[1],[aqiFromPM(pm)])
-      count += 1
+      interpolator = AQIInterpolator(interpolation_bounds,resolution=resolution)
+      for member, pos in result:
+         _, _, readings = decode_member(member)
+         pm = readings[index]
+         interpolator.add(pos[0],pos[1],[aqiFromPM(pm)])
+         count += 1
+
+      loaded = time();
+      print('Loaded: '+str(loaded-start))
 
-   loaded = time();
-   print('Loaded: '+str(loaded-start))
+      if count==0:
+         return jsonify({
+            'bounds' : interpolation_bounds,
+            'grid' : []
+         }).get_data()
 
-   if count==0:
+      grid = interpolator.generate_grid(method=method,index=0)
+      done = time();
+      print('Interpolation: '+str(done-loaded))
       return jsonify({
          'bounds' : interpolation_bounds,
-         'grid' : []
-      })
+         'resolution' : interpolator.resolution,
+         'grid' : grid.tolist()
+      }).get_data()
 
-   grid = interpolator.generate_grid(method=method,index=0)
-   done = time();
-   print('Interpolation: '+str(done-loaded))
-   return jsonify({
-      'bounds' : interpolation_bounds,
-      'resolution' : interpolator.resolution,
-      'grid' : grid.tolist()
-   })
+   return cached(partition_set,'interpolate/{},{},{},{}/{}/{}/{}'.format(nwlat,nwlon,selat,selon,resolution,index,method),query)
 
 @aqi.route('/api/partitions')
 def partitions():
@@ -299,7 +343,12 @@ def partitions():
    start = request.args.get('start')
    end = request.args.get('end')
 
-   key = current_app.config['KEY_PREFIX'] + 'PT' + str(current_app.config['PARTITION']) + 'M'
+   # the raw partitions or the rollups (see rollup.py)
+   duration = request.args.get('duration','PT' + str(current_app.config['PARTITION']) + 'M')
+   if duration not in ['PT' + str(current_app.config['PARTITION']) + 'M', 'PT1H', 'P1D']:
+      return jsonify({'error':'Unsupported partition duration: '+duration}),400
+
+   key = current_app.config['KEY_PREFIX'] + duration
 
    first = redis.zrange(key,0,0)
    last = redis.zrevrange(key,0,0)
@@ -310,11 +359,11 @@ def partitions():
       return jsonify({})
 
    first = first[0].decode('utf-8')
-   first_datetime = first[prefix_len:first.rfind('PT')]
+   first_datetime = first[prefix_len:first.rfind('P')]
    last = last[0].decode('utf-8')
-   last_datetime = last[prefix_len:last.rfind('PT')]
+   last_datetime = last[prefix_len:last.rfind('P')]
 
-   partition_info = {'duration' : 'PT' + str(current_app.config['PARTITION']) + 'M', 'first': {'at': first_datetime, 'partition':first}, 'last': {'at': last_datetime, 'partition':last}}
+   partition_info = {'duration' : duration, 'first': {'at': first_datetime, 'partition':first}, 'last': {'at': last_datetime, 'partition':last}}
    if start is None and end is None:
       return jsonify(partition_info)
 
@@ -346,6 +395,96 @@ def partitions():
    return jsonify(partition_info)
 
 
+@aqi.route('/api/partitions/region')
+def partitions_region():
+   client = get_redis()
+
+   start = request.args.get('start')
+   end = request.args.get('end')
+
+   duration = request.args.get('duration','PT' + str(current_app.config['PARTITION']) + 'M')
+   if duration not in ['PT' + str(current_app.config['PARTITION']) + 'M', 'PT1H', 'P1D']:
+      return jsonify({'error':'Unsupported partition duration: '+duration}),400
+
+   aggregate = request.args.get('aggregate','false').lower() in ['1','true','yes']
+
+   try:
+      nwlat = float(request.args.get('nwlat')) if 'nwlat' in request.args else None
+      nwlon = float(request.args.get('nwlon')) if 'nwlon' in request.args else None
+      selat = float(request.args.get('selat')) if 'selat' in request.args else None
+      selon = float(request.args.get('selon')) if 'selon' in request.args else None
+      max_cells = int(request.args.get('max_cells')) if 'max_cells' in request.args else None
+
+      if start is None or end is None:
+         return jsonify({'error': 'Both start and end must be specified.'}), 400
+      if start.find('T')<0:
+         start += 'T00:00:00'
+      if end.find('T')<0:
+         end += 'T23:59:59'
+      start = datetime.fromisoformat(start)
+      end = datetime.fromisoformat(end)
+   except ValueError as e:
+      return jsonify({'error':'Invalid parameter value: '+str(e)}),400
+
+   if None in [nwlat,nwlon,selat,selon]:
+      return jsonify({'error': 'The bounds of the quadrangle are not completely specified. All of nwlat, nwlon, selat, and selon must be specified.'}), 400
+
+   shard_size = current_app.config.get('SHARD_SIZE')
+   shard_size = float(shard_size) if shard_size is not None else None
+
+   # the work of a request is bounded by the number of partitions times the number of cells
+   max_partitions = current_app.config['REGION_MAX_PARTITIONS']
+   region_max_cells = current_app.config['REGION_MAX_CELLS']
+   partition_count = client.zcount(current_app.config['KEY_PREFIX'] + duration,datetime_score(start),datetime_score(end))
+   if partition_count > max_partitions:
+      return jsonify({'error': 'The range contains {} partitions, more than the maximum of {}.'.format(partition_count,max_partitions)}), 400
+   if max_cells is not None and shard_size is None:
+      if max_cells < 1 or max_cells > region_max_cells:
+         return jsonify({'error': 'max_cells must be between 1 and {}.'.format(region_max_cells)}), 400
+      # the covering is larger than max_cells when the region is larger than the coarsest covering allows
+      cell_count = len(adaptive_covering((nwlat,nwlon),(selat,selon),max_cells=max_cells))
+   else:
+      cell_count = len(sequence_number_array_for_bounds(shard_size if shard_size is not None else 0.5,(nwlat,nwlon),(selat,selon)))
+   if cell_count > region_max_cells:
+      return jsonify({'error': 'The region is covered by {} cells, more than the maximum of {}.'.format(cell_count,region_max_cells)}), 400
+
+   results = query_partitions(client,current_app.config['KEY_PREFIX'],start,end,(nwlat,nwlon),(selat,selon),duration=duration,shard_size=shard_size,max_cells=max_cells,aggregate=aggregate)
+
+   # query up to the first partition so that errors are returned before the response starts
+   try:
+      first = next(results,None)
+   except Exception as e:
+      return jsonify({'error': 'The query failed: '+str(e)}), 500
+
+   def partitions():
+      if first is not None:
+         yield first
+         yield from results
+
+   def generate():
+      # a JSON array of the partitions as they are queried
+      yield '['
+      separator = ''
+      try:
+         for partition, values in partitions():
+            if aggregate:
+               item = dict(values,partition=partition)
+            else:
+               data = []
+               for member, pos in values:
+                  id, minute, readings = decode_member(member)
+                  data.append([id,minute] + [pos[0],pos[1]] + readings)
+               item = {'partition' : partition, 'data' : data}
+            yield separator + json.dumps(item)
+            separator = ','
+      except Exception as e:
+         # the status has been sent and so the error is the last item
+         yield separator + json.dumps({'error': 'The query failed: '+str(e)})
+      yield ']'
+
+   return current_app.response_class(stream_with_context(generate()),mimetype='application/json')
+
+
 assets = Blueprint('aqi_assets',__name__)
 @assets.route('/assets/<path:path>')
 @gzipped
@@ -362,7 +501,7 @@ def send_asset(path):
 def from_env(name,default_value,dtype=str):
    return dtype(os.environ[name]) if name in os.environ else default_value
 
-def create_app(host='0.0.0.0',port=6379,password=None,prefix='AQI30-',partition=30,app=None):
+def create_app(host='0.0.0.0',port=6379,password=None,prefix='AQI30-',partition=30,shard_size=None,cluster=False,cache_size=64,cache_shared=False,cache_ttl=3600,region_max_partitions=96,region_max_cells=1024,app=None):
    app = Flask(__name__)
    if 'AQI_CONF' in os.environ:
       app.config.from_envvar('AQI_CONF')
@@ -378,6 +517,23 @@ def create_app(host='0.0.0.0',port=6379,password=None,prefix='AQI30-',partition=
       app.config['KEY_PREFIX'] = from_env('KEY_PREFIX',prefix)
    if 'PARTITION' not in app.config:
       app.config['PARTITION'] = from_env('PARTITION',partition)
+   if 'SHARD_SIZE' not in app.config:
+      app.config['SHARD_SIZE'] = from_env('SHARD_SIZE',shard_size,dtype=float)
+   if 'REDIS_CLUSTER' not in app.config:
+      app.config['REDIS_CLUSTER'] = from_env('REDIS_CLUSTER',cluster,dtype=lambda v : v.lower() in ['1','true','yes'])
+   if 'CACHE_SIZE' not in app.config:
+      app.config['CACHE_SIZE'] = from_env('CACHE_SIZE',cache_size,dtype=float)
+   if 'CACHE_SHARED' not in app.config:
+      app.config['CACHE_SHARED'] = from_env('CACHE_SHARED',cache_shared,dtype=lambda v : v.lower() in ['1','true','yes'])
+   if 'CACHE_TTL' not in app.config:
+      app.config['CACHE_TTL'] = from_env('CACHE_TTL',cache_ttl,dtype=int)
+   if 'REGION_MAX_PARTITIONS' not in app.config:
+      app.config['REGION_MAX_PARTITIONS'] = from_env('REGION_MAX_PARTITIONS',region_max_partitions,dtype=int)
+   if 'REGION_MAX_CELLS' not in app.config:
+      app.config['REGION_MAX_CELLS'] = from_env('REGION_MAX_CELLS',region_max_cells,dtype=int)
+   # the query results of closed partitions (CACHE_SIZE is in MB, 0 disables the cache)
+   if app.config['CACHE_SIZE'] > 0:
+      app.extensions['aqi_cache'] = PartitionCache(max_size=int(app.config['CACHE_SIZE']*1024*1024),shared=app.config['CACHE_SHARED'],ttl=app.config['CACHE_TTL'],prefix=app.config['KEY_PREFIX'])
    return app
 
 class Config(object):
@@ -387,6 +543,13 @@ class Config(object):
    REDIS_PASSWORD = from_env('REDIS_PASSWORD',None)
    KEY_PREFIX = from_env('KEY_PREFIX','AQI30-')
    PARTITION = from_env('PARTITION',30)
+   SHARD_SIZE = from_env('SHARD_SIZE',None,dtype=float)
+   REDIS_CLUSTER = from_env('REDIS_CLUSTER',False,dtype=lambda v : v.lower() in ['1','true','yes'])
+   CACHE_SIZE = from_env('CACHE_SIZE',64,dtype=float)
+   CACHE_SHARED = from_env('CACHE_SHARED',False,dtype=lambda v : v.lower() in ['1','true','yes'])
+   CACHE_TTL = from_env('CACHE_TTL',3600,dtype=int)
+   REGION_MAX_PARTITIONS = from_env('REGION_MAX_PARTITIONS',96,dtype=int)
+   REGION_MAX_CELLS = from_env('REGION_MAX_CELLS',1024,dtype=int)
 
 def main():
    argparser = argparse.ArgumentParser(description='Web')
@@ -396,13 +559,20 @@ def main():
    argparser.add_argument('--config',help='configuration file')
    argparser.add_argument('--key-prefix',help='The key prefix.',default='AQI30-')
    argparser.add_argument('--partition',help='The time partition (in minutes, must be a divisor of 60)',default=30,type=int)
+   argparser.add_argument('--shard-size',help='The shard quadrangle size used at ingest',type=float)
+   argparser.add_argument('--cluster',help='Connect to a Redis Cluster',action='store_true',default=False)
+   argparser.add_argument('--cache-size',help='The size (MB) of the query result cache of closed partitions (0 disables the cache)',type=float,default=64)
+   argparser.add_argument('--cache-shared',help='Also share the cached query results in Redis',action='store_true',default=False)
+   argparser.add_argument('--cache-ttl',help='The number of seconds until shared cached query results expire',type=int,default=3600)
+   argparser.add_argument('--region-max-partitions',help='The maximum number of partitions of a region query',type=int,default=96)
+   argparser.add_argument('--region-max-cells',help='The maximum number of covering cells of a region query',type=int,default=1024)
    args = argparser.parse_args()
 
    if 60 % args.partition:
       print('The partition {} is not a divisor of 60'.format(args.partition))
       sys.exit(1)
 
-   app = create_app(host=args.host,port=args.port,password=args.password,prefix=args.key_prefix,partition=args.partition)
+   app = create_app(host=args.host,port=args.port,password=args.password,prefix=args.key_prefix,partition=args.partition,shard_size=args.shard_size,cluster=args.cluster,cache_size=args.cache_size,cache_shared=args.cache_shared,cache_ttl=args.cache_ttl,region_max_partitions=args.region_max_partitions,region_max_cells=args.region_max_cells)
    if args.config is not None:
       import os
       app.config.from_pyfile(os.path.abspath(args.config))
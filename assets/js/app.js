@@ -28,7 +28,7 @@ function quadrangleForSequenceNumber(size,s) {
 
 
 function* sequenceNumbersForBounds(size,...args) {
-   let nw = null, sw = null;
+   let nw = null, se = null;
    if (args.length==1) {
       nw = args[0][0];
       se = args[0][1];
@@ -45,7 +45,7 @@ function* sequenceNumbersForBounds(size,...args) {
       for (let s of sequenceNumbersForBounds(size,nw,[se[0],-p])) {
          yield s;
       }
-      for (let s in sequenceNumbersForBounds(size,[nw[0],p],se)) {
+      for (let s of sequenceNumbersForBounds(size,[nw[0],p],se)) {
          yield s;
       }
    }
@@ -64,6 +64,76 @@ function* sequenceNumbersForBounds(size,...args) {
    }
 }
 
+// A covering of the bounds by at most maxCells quadrangles of mixed sizes
+// as [size, sequence number] pairs (see geo.adaptive_covering)
+function adaptiveCovering(nw,se,maxCells=16,minSize=0.125,maxSize=4.0) {
+   let sizes = [maxSize];
+   while (sizes[sizes.length-1]/2 >= minSize) {
+      sizes.push(sizes[sizes.length-1]/2);
+   }
+
+   let size = sizes[0];
+   let numbers = Array.from(sequenceNumbersForBounds(size,nw,se));
+   for (let finer of sizes.slice(1)) {
+      let finerNumbers = Array.from(sequenceNumbersForBounds(finer,nw,se));
+      if (finerNumbers.length > maxCells) {
+         break;
+      }
+      [size, numbers] = [finer, finerNumbers];
+   }
+
+   let intersection = (q_nw,q_se) => {
+      let latSize = Math.min(nw[0],q_nw[0]) - Math.max(se[0],q_se[0]);
+      let lonSize = Math.min(se[1],q_se[1]) - Math.max(nw[1],q_nw[1]);
+      return latSize > 0 && lonSize > 0 ? latSize*lonSize : 0;
+   };
+
+   // [waste, size, sequence number] of the quadrangles that may be divided
+   let covering = new Map();
+   let candidates = [];
+   for (let number of numbers) {
+      let [q_nw, q_se] = quadrangleForSequenceNumber(size,number);
+      covering.set(`${size}/${number}`,[size,number]);
+      candidates.push([size*size - intersection(q_nw,q_se),size,number]);
+   }
+
+   while (candidates.length > 0) {
+      // divide the quadrangle with the most area outside the bounds (then the smallest and first)
+      let most = 0;
+      for (let i=1; i<candidates.length; i++) {
+         let [a, b] = [candidates[i], candidates[most]];
+         if (a[0] > b[0] || (a[0]==b[0] && (a[1] < b[1] || (a[1]==b[1] && a[2] < b[2])))) {
+            most = i;
+         }
+      }
+      let [wasted, cellSize, number] = candidates.splice(most,1)[0];
+      let half = cellSize/2;
+      if (wasted==0 || half < minSize) {
+         continue;
+      }
+      let [q_nw, q_se] = quadrangleForSequenceNumber(cellSize,number);
+      let children = [];
+      for (let i=0; i<2; i++) {
+         for (let j=0; j<2; j++) {
+            let c_nw = [q_nw[0] - i*half, q_nw[1] + j*half];
+            let c_se = [c_nw[0] - half, c_nw[1] + half];
+            if (intersection(c_nw,c_se) > 0) {
+               children.push([half,sequenceNumber(half,[c_nw[0] - half/2, c_nw[1] + half/2]),c_nw,c_se]);
+            }
+         }
+      }
+      if (covering.size - 1 + children.length > maxCells) {
+         continue;
+      }
+      covering.delete(`${cellSize}/${number}`);
+      for (let [childSize, child, c_nw, c_se] of children) {
+         covering.set(`${childSize}/${child}`,[childSize,child]);
+         candidates.push([childSize*childSize - intersection(c_nw,c_se),childSize,child]);
+      }
+   }
+   return Array.from(covering.values());
+}
+
 function calculateAQI(Cp, Ih, Il, BPh, BPl) {
    a = Ih - Il
    b = BPh - BPl
@@ -125,6 +195,7 @@ class AQIInterpolator {
 
    init() {
       this.loadedSequenceNumbers = {}
+      this.shownSensors = {}
       let center = [37.7749, -122.4194]
       this.map = L.map('map').setView(center, 14);
       this.heatmap = L.layerGroup().addTo(this.map);
@@ -286,6 +357,7 @@ class AQIInterpolator {
    clearSensors() {
       this.sensors.clearLayers();
       this.loadedSequenceNumbers = {}
+      this.shownSensors = {}
    }
 
    loadSensorsForMap(partition) {
@@ -296,9 +368,8 @@ class AQIInterpolator {
       let bounds = app.map.getBounds();
       let nw = bounds.getNorthWest();
       let se = bounds.getSouthEast();
-      let size = 0.5;
-      for (let seqno of sequenceNumbersForBounds(size,[nw.lat,nw.lng],[se.lat,se.lng])) {
-         if (seqno in this.loadedSequenceNumbers)  {
+      for (let [size, seqno] of adaptiveCovering([nw.lat,nw.lng],[se.lat,se.lng])) {
+         if (this.isLoaded(size,seqno))  {
             continue;
          }
          let url = `/api/q/${size}/n/${seqno}/${datetime}`;
@@ -306,7 +377,7 @@ class AQIInterpolator {
          fetch(url)
             .then(response => response.json())
             .then(data => {
-               this.loadedSequenceNumbers[seqno] = true;
+               this.loadedSequenceNumbers[`${size}/${seqno}`] = true;
                setTimeout(() => {
                   this.showSensors(data);
                },1);
@@ -317,6 +388,18 @@ class AQIInterpolator {
       }
    }
 
+   // a quadrangle is loaded when it or a larger quadrangle that contains it is loaded
+   isLoaded(size,seqno) {
+      let [nw, se] = quadrangleForSequenceNumber(size,seqno);
+      let center = [nw[0] - size/2, nw[1] + size/2];
+      for (let ancestor = size; ancestor <= 4.0; ancestor *= 2) {
+         if (`${ancestor}/${sequenceNumber(ancestor,center)}` in this.loadedSequenceNumbers) {
+            return true;
+         }
+      }
+      return false;
+   }
+
    resizeSensors() {
       let zoom = this.map.getZoom();
       let scale = zoom/20.0;
@@ -336,6 +419,11 @@ class AQIInterpolator {
       console.log(`Radius ${radius}, scale ${scale}`);
       for (let sensor of data) {
          let [id, offset, lat, lon, pm] = sensor;
+         // a smaller quadrangle may have been loaded before a larger one that contains it
+         if (`${id}@${offset}` in this.shownSensors) {
+            continue;
+         }
+         this.shownSensors[`${id}@${offset}`] = true;
          let aqi = aqiFromPM(pm);
          let color = this.aqiColor(aqi);
          L.circleMarker([lat,lon],{radius: radius, weight: 0, color: color, opacity: opacity}).bindTooltip(`${aqi}`,{permanant:true,direction: 'center',offset: [0, 15], opacity: 0.65}).addTo(this.sensors);
@@ -0,0 +1,136 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from members import fromisoformat, version_key
+
+def partition_end(partition):
+   """
+   Returns the end of a partition given its datetime and duration (e.g.,
+   2020-09-10T11:30:00PT30M, 2020-09-10T11:00:00PT1H, or 2020-09-10T00:00:00P1D)
+   or None if the duration is not known.
+   """
+   position = partition.rfind('P')
+   start = fromisoformat(partition[:position])
+   duration = partition[position:]
+   if duration=='P1D':
+      return start + timedelta(days=1)
+   if duration.startswith('PT') and duration.endswith('H'):
+      return start + timedelta(hours=int(duration[2:-1]))
+   if duration.startswith('PT') and duration.endswith('M'):
+      return start + timedelta(minutes=int(duration[2:-1]))
+   return None
+
+class LRUCache:
+   """
+   A thread-safe in-process cache of bytes values that evicts the least
+   recently used values when the total size exceeds max_size bytes.
+   """
+   def __init__(self,max_size=64*1024*1024):
+      self.max_size = max_size
+      self.size = 0
+      self.values = OrderedDict()
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+
+   def __len__(self):
+      return len(self.values)
+
+   def get(self,key):
+      with self.lock:
+         value = self.values.get(key)
+         if value is None:
+            self.misses += 1
+            return None
+         self.values.move_to_end(key)
+         self.hits += 1
+         return value
+
+   def put(self,key,value):
+      if len(value) > self.max_size:
+         return
+      with self.lock:
+         previous = self.values.pop(key,None)
+         if previous is not None:
+            self.size -= len(previous)
+         self.values[key] = value
+         self.size += len(value)
+         while self.size > self.max_size:
+            _, evicted = self.values.popitem(last=False)
+            self.size -= len(evicted)
+
+class PartitionCache:
+   """
+   A cache of the encoded query results of closed partitions. A partition is
+   closed once its duration has ended (plus a grace period for the last
+   ingest) and its results are then keyed by the version stamp of the
+   partition (see members.version_key) so that a re-ingest invalidates them.
+
+   Only the partitions registered in their partition set (e.g.,
+   AQI30-PT30M) are cached. Rollup removes the partitions it compacts from
+   the partition set before they are deleted or expire so that their cached
+   results are not served after the data is gone.
+
+   The results are kept in an in-process LRU cache and, when shared is
+   true, also in Redis (expiring after ttl seconds) so that they are shared
+   by every application process.
+   """
+   def __init__(self,max_size=64*1024*1024,shared=False,ttl=3600,prefix='AQI30-',grace=300):
+      self.local = LRUCache(max_size)
+      self.shared = shared
+      self.ttl = ttl
+      self.prefix = prefix
+      self.grace = grace
+
+   def is_closed(self,partition,now=None):
+      try:
+         end = partition_end(partition)
+      except ValueError:
+         return False
+      if end is None:
+         return False
+      now = now if now is not None else datetime.utcnow()
+      return end + timedelta(seconds=self.grace) <= now
+
+   def version(self,client,partition):
+      """
+      Returns the version stamp of a partition or None if the partition is
+      not registered in its partition set.
+      """
+      key = self.prefix + partition
+      pipe = client.pipeline(transaction=False)
+      pipe.hget(version_key(self.prefix),key)
+      # prefix + duration (e.g., AQI30-PT30M)
+      pipe.zscore(self.prefix + partition[partition.rfind('P'):],key)
+      version, score = pipe.execute()
+      if score is None:
+         return None
+      return version.decode('utf-8') if version is not None else '0'
+
+   def get(self,client,partition,query,compute):
+      """
+      Returns the encoded result of the query of a partition (e.g.,
+      2020-09-10T11:30:00PT30M) and whether it was cached. The compute
+      function returns the encoded result (bytes) when it is not cached.
+      Only the results of closed partitions are cached.
+      """
+      if not self.is_closed(partition):
+         return compute(), False
+      version = self.version(client,partition)
+      if version is None:
+         return compute(), False
+      key = self.prefix + partition + '@' + version + '/' + query
+      value = self.local.get(key)
+      if value is not None:
+         return value, True
+      if self.shared:
+         value = client.get(self.prefix + 'cache:' + key)
+         if value is not None:
+            self.local.put(key,value)
+            return value, True
+      value = compute()
+      self.local.put(key,value)
+      if self.shared:
+         client.set(self.prefix + 'cache:' + key,value,ex=self.ttl)
+      return value, False
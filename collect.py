@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import requests
 from datetime import datetime
 import time
@@ -6,24 +7,282 @@ import json
 import signal
 import sys
 import os
+import io
+import gzip
+import queue
+import threading
+from array import array
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+
+# the integer array type codes from the narrowest with their ranges
+_int_types = [('b',-2**7,2**7-1),('h',-2**15,2**15-1),('i',-2**31,2**31-1),('q',-2**63,2**63-1)]
+
+_int_order = {typecode : order for order, (typecode, _, _) in enumerate(_int_types)}
+
+def _int_type(low,high):
+   for typecode, minimum, maximum in _int_types:
+      if minimum <= low and high <= maximum:
+         return typecode
+   return None
+
+class Column:
+   """
+   The values of a field. Integers and floats are kept in arrays (the
+   narrowest integer type that holds the values or float64) as long as the
+   values allow it, where the positions of the null values and of the
+   integers in a float column are tracked separately. Otherwise, the values
+   are kept in a list with the strings interned.
+   """
+   def __init__(self,length=0):
+      # None (only nulls so far), 'i' (integer array), 'd' (float64 array), or 'o' (list)
+      self.kind = None
+      self.values = None
+      self.length = length
+      self.nulls = set(range(length))
+      self.integers = set()
+
+   def _to_list(self):
+      self.values = self.slice(0,self.length)
+      self.kind = 'o'
+      self.nulls = set()
+      self.integers = set()
+
+   def _fit(self,low,high):
+      # widens the integer array to hold the values
+      typecode = _int_type(min(low,0),max(high,0))
+      if self.kind is None:
+         self.kind = 'i'
+         self.values = array(typecode,bytes(array(typecode).itemsize*self.length))
+      elif _int_order[typecode] > _int_order[self.values.typecode]:
+         self.values = array(typecode,self.values)
+
+   def append(self,value):
+      kind = type(value)
+      position = self.length
+      if self.kind!='o':
+         if value is None:
+            self.nulls.add(position)
+            if self.values is not None:
+               self.values.append(0)
+            self.length += 1
+            return
+         integer = kind==int and _int_type(value,value) is not None
+         if self.kind is None:
+            if integer:
+               self._fit(value,value)
+            elif kind==float:
+               self.kind = 'd'
+               self.values = array('d',bytes(8*position))
+            else:
+               self._to_list()
+         if self.kind=='i':
+            if integer:
+               self._fit(value,value)
+               self.values.append(value)
+               self.length += 1
+               return
+            if kind==float:
+               self.kind = 'd'
+               self.integers = set(range(position)) - self.nulls
+               self.values = array('d',self.values)
+            else:
+               self._to_list()
+         if self.kind=='d':
+            if kind==float:
+               self.values.append(value)
+               self.length += 1
+               return
+            if kind==int and -2**53 <= value <= 2**53:
+               self.integers.add(position)
+               self.values.append(value)
+               self.length += 1
+               return
+            self._to_list()
+      self.values.append(sys.intern(value) if kind==str else value)
+      self.length += 1
+
+   def extend(self,values):
+      if len(values)==0:
+         return
+      if self.kind=='d' and all(type(value)==float for value in values):
+         self.values.extend(values)
+         self.length += len(values)
+      elif self.kind in (None,'i') and all(type(value)==int for value in values) and _int_type(min(values),max(values)) is not None:
+         self._fit(min(values),max(values))
+         self.values.extend(values)
+         self.length += len(values)
+      else:
+         for value in values:
+            self.append(value)
+
+   def slice(self,start,end):
+      """
+      Returns the values in [start,end) as a list.
+      """
+      if self.kind=='o':
+         return self.values[start:end]
+      if self.kind is None:
+         return [None]*(end - start)
+      values = self.values[start:end].tolist()
+      for position in self.integers:
+         if start <= position < end:
+            values[position - start] = int(values[position - start])
+      for position in self.nulls:
+         if start <= position < end:
+            values[position - start] = None
+      return values
+
+class PartitionBuffer:
+   """
+   A compact buffer of the polls of a partition. The timestamp is kept once
+   per poll and each field is a Column. The rows are only materialized in
+   the collected format (the timestamp followed by the fields) when needed.
+   """
+   def __init__(self,headers=None):
+      self.headers = headers
+      # (timestamp, number of rows) of each poll
+      self.polls = []
+      self.columns = []
+      self.length = 0
+
+   def __len__(self):
+      return self.length
+
+   def append(self,timestamp,rows):
+      if len(rows)==0:
+         return
+      self.polls.append((sys.intern(timestamp),len(rows)))
+      width = max(map(len,rows))
+      while len(self.columns) < width:
+         self.columns.append(Column(self.length))
+      for position, column in enumerate(self.columns):
+         column.extend([row[position] if position < len(row) else None for row in rows])
+      self.length += len(rows)
+
+   def timestamps(self):
+      """
+      Returns the timestamp of each row.
+      """
+      values = []
+      for timestamp, count in self.polls:
+         values.extend([timestamp]*count)
+      return values
+
+   def field_columns(self):
+      """
+      Returns the values of each field (starting with the timestamp) as lists.
+      """
+      return [self.timestamps()] + [column.slice(0,self.length) for column in self.columns]
+
+   def rows(self):
+      """
+      Iterates the header row (if known) and the rows poll by poll.
+      """
+      if self.headers is not None:
+         yield self.headers
+      # each column is materialized once as slicing scans its null and integer positions
+      columns = [column.slice(0,self.length) for column in self.columns]
+      start = 0
+      for timestamp, count in self.polls:
+         end = start + count
+         for values in zip(*[values[start:end] for values in columns]):
+            yield [timestamp] + list(values)
+         start = end
+
+   def to_rows(self):
+      return list(self.rows())
+
+   def write_json(self,output):
+      """
+      Writes the rows as a JSON array (as json.dump would) one row at a time.
+      """
+      output.write('[')
+      separator = ''
+      for row in self.rows():
+         output.write(separator)
+         output.write(json.dumps(row))
+         separator = ', '
+      output.write(']')
 
 def dump_storage(start,data):
    sys.stdout.write('\u001e')
-   json.dump({'start': start.isoformat(), 'data' : data},sys.stdout)
+   if isinstance(data,PartitionBuffer):
+      sys.stdout.write('{"start": ' + json.dumps(start.isoformat()) + ', "data": ')
+      data.write_json(sys.stdout)
+      sys.stdout.write('}')
+   else:
+      json.dump({'start': start.isoformat(), 'data' : data},sys.stdout)
    sys.stdout.write('\n')
    sys.stdout.flush()
+dump_storage.buffered = True
+
+# the file suffix and content type of each partition format
+formats = {
+   'json' : ('.json','application/json;charset=utf-8'),
+   'columnar' : ('.aqc','application/octet-stream')
+}
+
+# the additional file suffix and content type of each partition compression
+compressions = {
+   None : ('',None),
+   'gzip' : ('.gz','application/gzip'),
+   'zstd' : ('.zst','application/zstd')
+}
+
+def partition_suffix(format='json',compression=None):
+   """
+   Returns the file suffix and content type of a partition format and compression.
+   """
+   suffix, content_type = formats[format]
+   compressed_suffix, compressed_type = compressions[compression]
+   return suffix + compressed_suffix, compressed_type if compressed_type is not None else content_type
+
+def encode_partition(data,compression=None,format='json'):
+   """
+   Serializes a partition (rows or a PartitionBuffer) as JSON or in the
+   columnar format (see columnar.py) and optionally compresses it with gzip
+   or zstd (requires the zstandard package).
+   """
+   if format=='columnar':
+      import columnar
+      if isinstance(data,PartitionBuffer):
+         body = columnar.encode_columns(data.headers,data.field_columns(),len(data))
+      else:
+         body = columnar.encode(data)
+   elif isinstance(data,PartitionBuffer):
+      output = io.StringIO()
+      data.write_json(output)
+      body = output.getvalue().encode('utf-8')
+   else:
+      body = json.dumps(data).encode('utf-8')
+   if compression=='gzip':
+      return gzip.compress(body)
+   if compression=='zstd':
+      import zstandard
+      return zstandard.ZstdCompressor().compress(body)
+   return body
 
-def create_dir_action(dir,prefix='data-'):
+def create_dir_action(dir,prefix='data-',compression=None,format='json'):
+
+   suffix, _ = partition_suffix(format,compression)
 
    def dir_storage(start,data):
-      name = prefix + start.isoformat() + '.json'
-      with open(os.path.join(dir,name),'w') as output:
-         json.dump(data,output)
+      name = prefix + start.isoformat() + suffix
+      if compression is None and format=='json':
+         with open(os.path.join(dir,name),'w') as output:
+            if isinstance(data,PartitionBuffer):
+               data.write_json(output)
+            else:
+               json.dump(data,output)
+      else:
+         with open(os.path.join(dir,name),'wb') as output:
+            output.write(encode_partition(data,compression,format))
+   dir_storage.buffered = True
    return dir_storage
 
-def create_s3_storage_action(bucket_name,verbose=False,endpoint=None,key=None,secret=None,prefix='data-'):
+def create_s3_storage_action(bucket_name,verbose=False,endpoint=None,key=None,secret=None,prefix='data-',multipart_threshold=8*1024*1024,compression=None,format='json'):
    kwargs = {}
    if endpoint is not None:
       kwargs['endpoint_url'] = endpoint
@@ -38,25 +297,254 @@ def create_s3_storage_action(bucket_name,verbose=False,endpoint=None,key=None,se
       "s3",
       **kwargs
    )
+   suffix, content_type = partition_suffix(format,compression)
 
    def s3_storage(start,data):
 
-      key_name = prefix + start.isoformat() + '.json'
+      key_name = prefix + start.isoformat() + suffix
 
-      body = json.dumps(data).encode('utf-8')
+      body = encode_partition(data,compression,format)
 
       if verbose:
          print("Storing data to "+key_name,flush=True)
 
-      client.put_object(Bucket=bucket_name,Key=key_name,Body=body,ContentLength=len(body),ContentType='application/json;charset=utf-8')
+      if len(body) < multipart_threshold:
+         client.put_object(Bucket=bucket_name,Key=key_name,Body=body,ContentLength=len(body),ContentType=content_type)
+      else:
+         # large partitions are uploaded in parts (and the parts are retried individually)
+         client.upload_fileobj(io.BytesIO(body),bucket_name,key_name,ExtraArgs={'ContentType':content_type},Config=TransferConfig(multipart_threshold=multipart_threshold,multipart_chunksize=multipart_threshold))
 
       if verbose:
          print("Complete",flush=True)
 
+   s3_storage.buffered = True
    return s3_storage
 
+def create_redis_action(client,prefix='AQI30-',partition=30,precision=None,encoding='text',shard_size=None,group_size=500,verbose=False):
+   """
+   Returns an action that ingests rows in the partition format (e.g., each
+   poll) directly into the partition keys in Redis with ingest.ingest so
+   that the members, the partition set registration (e.g., AQI30-PT30M),
+   and the pipelining are the same as a later ingest of the partition.
+   """
+   # ingest depends on redis and numpy which are otherwise not needed to collect
+   from ingest import ingest
+   from reader import without_removed
+
+   def redis_ingest(start,data):
+      # the sensors that are no longer reported (--delta) are not readings
+      data = list(without_removed(data))
+      if len(data)<=1:
+         return
+      try:
+         count = ingest(client,data,precision=precision,partition=partition,prefix=prefix,group_size=group_size,encoding=encoding,shard_size=shard_size)
+      except Exception as ex:
+         # the poll is still stored with the partition
+         print('Cannot ingest poll for {start}: {error}'.format(start=start.isoformat(),error=str(ex)),file=sys.stderr,flush=True)
+         return
+      if verbose:
+         print('Ingested {count} readings into {prefix}{start}PT{partition}M'.format(count=count,prefix=prefix,start=start.isoformat(),partition=partition),flush=True)
+   return redis_ingest
+
+def poll_actions(actions):
+   """
+   Returns an action that calls each of the actions in turn.
+   """
+   actions = [action for action in actions if action is not None]
+   if len(actions)<=1:
+      return actions[0] if len(actions)==1 else None
+   def all_actions(start,data):
+      for action in actions:
+         action(start,data)
+   return all_actions
+
+class Flusher:
+   """
+   Stores finished partitions on a background thread so that a slow store
+   action (e.g., an S3 upload) does not delay the next poll. Partitions are
+   stored in the order they were submitted and a failed store is retried
+   with exponential backoff. The queue is bounded; when it is full, submit
+   blocks until a partition has been stored.
+   """
+   def __init__(self,queue_size=4,retries=5,backoff=1.0,verbose=False):
+      self.queue = queue.Queue(maxsize=queue_size)
+      self.retries = retries
+      self.backoff = backoff
+      self.verbose = verbose
+      self.lock = threading.Lock()
+      self.stored = 0
+      self.failed = 0
+      self.retried = 0
+      self.last_latency = None
+      self.max_latency = 0
+      self.thread = threading.Thread(target=self.run,daemon=True)
+      self.thread.start()
+
+   def submit(self,action,start,data,done=None):
+      """
+      Queues a partition to be stored by the action. The done function, if
+      any, is called once the partition has been stored.
+      """
+      if self.queue.full():
+         print('Flush queue is full ({size}), waiting to store {start}'.format(size=self.queue.maxsize,start=start.isoformat()),file=sys.stderr,flush=True)
+      self.queue.put((action,start,data,time.time(),done))
+
+   def depth(self):
+      return self.queue.qsize()
+
+   def stats(self):
+      """
+      Returns the queue depth, the number of partitions stored, failed, and
+      retried, and the last and maximum latency (seconds from submission
+      until stored).
+      """
+      with self.lock:
+         return {
+            'depth' : self.depth(),
+            'stored' : self.stored,
+            'failed' : self.failed,
+            'retried' : self.retried,
+            'last_latency' : self.last_latency,
+            'max_latency' : self.max_latency
+         }
+
+   def flush(self,action,start,data):
+      for attempt in range(self.retries + 1):
+         try:
+            action(start,data)
+            return True
+         except Exception as ex:
+            if attempt==self.retries:
+               print('Unable to store {start}: {error}'.format(start=start.isoformat(),error=str(ex)),file=sys.stderr,flush=True)
+               return False
+            delay = self.backoff * 2**attempt
+            print('Storing {start} failed ({error}), retrying in {delay}s'.format(start=start.isoformat(),error=str(ex),delay=delay),file=sys.stderr,flush=True)
+            with self.lock:
+               self.retried += 1
+            time.sleep(delay)
+
+   def run(self):
+      while True:
+         item = self.queue.get()
+         if item is None:
+            self.queue.task_done()
+            return
+         action, start, data, submitted, done = item
+         success = self.flush(action,start,data)
+         if success and done is not None:
+            done()
+         latency = time.time() - submitted
+         with self.lock:
+            if success:
+               self.stored += 1
+            else:
+               self.failed += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency,latency)
+         if self.verbose:
+            print('Flushed {start} in {latency:.3f}s, queue depth {depth}'.format(start=start.isoformat(),latency=latency,depth=self.depth()),file=sys.stderr,flush=True)
+         self.queue.task_done()
+
+   def close(self):
+      """
+      Stores the queued partitions and stops the worker thread.
+      """
+      self.queue.put(None)
+      self.thread.join()
+
+class Spool:
+   """
+   An append-only write-ahead log of the polls of the partitions that have
+   not been stored yet. Each partition has its own segment file in the
+   directory, named by the collector name and the partition start, with a
+   record per poll. The segment is fsync'd at most every fsync_interval
+   seconds (0 syncs every poll) and is removed once the partition has been
+   stored.
+   """
+   def __init__(self,dir,name='collect',fsync_interval=0):
+      self.dir = dir
+      self.name = name
+      self.fsync_interval = fsync_interval
+      self.lock = threading.Lock()
+      self.output = None
+      self.start = None
+      self.synced = 0
+      os.makedirs(dir,exist_ok=True)
+
+   def path(self,start):
+      return os.path.join(self.dir,self.name + '-' + start.isoformat() + '.spool')
+
+   def append(self,start,headers,timestamp,rows):
+      with self.lock:
+         if self.output is None or self.start!=start:
+            self._close()
+            self.output = open(self.path(start),'a')
+            self.start = start
+         self.output.write('\u001e' + json.dumps({'timestamp':timestamp,'headers':headers,'rows':rows}) + '\n')
+         self.output.flush()
+         now = time.time()
+         if now - self.synced >= self.fsync_interval:
+            os.fsync(self.output.fileno())
+            self.synced = now
+
+   def _close(self):
+      if self.output is not None:
+         self.output.close()
+         self.output = None
+         self.start = None
+
+   def close(self):
+      with self.lock:
+         self._close()
+
+   def remove(self,start):
+      with self.lock:
+         if self.start==start:
+            self._close()
+         try:
+            os.remove(self.path(start))
+         except FileNotFoundError:
+            pass
+
+   def segments(self):
+      """
+      Returns the (start, path) of the segments in order of the partition start.
+      """
+      segments = []
+      prefix = self.name + '-'
+      for name in os.listdir(self.dir):
+         if name.startswith(prefix) and name.endswith('.spool'):
+            try:
+               start = datetime.fromisoformat(name[len(prefix):-len('.spool')])
+            except ValueError:
+               continue
+            segments.append((start,os.path.join(self.dir,name)))
+      return sorted(segments)
+
+   def read(self,path):
+      """
+      Returns the headers and the (timestamp, rows) of each poll in a
+      segment. A record that was only partially written is skipped.
+      """
+      headers = None
+      polls = []
+      with open(path,'r') as input:
+         # records are split on the record separator as a torn record has no newline
+         for text in input.read().split('\u001e'):
+            text = text.strip()
+            if len(text)==0:
+               continue
+            try:
+               record = json.loads(text)
+            except json.JSONDecodeError:
+               print('Skipping a partial record in '+path,file=sys.stderr,flush=True)
+               continue
+            headers = record['headers']
+            polls.append((record['timestamp'],record['rows']))
+      return headers, polls
+
 class Collector:
-   def __init__(self,url,interval=60,partition_interval=30,datetime_header='timestamp',verbose=False,store_action=dump_storage):
+   def __init__(self,url,interval=60,partition_interval=30,datetime_header='timestamp',verbose=False,store_action=dump_storage,poll_action=None,timeout=30,name=None,flusher=None,delta=False,keyframe_interval=10,delta_ignore=None,spool=None):
       self.url = url
       self.interval = interval
       self.partition_interval = partition_interval
@@ -67,6 +555,17 @@ class Collector:
       self.data = None
       self.verbose = verbose
       self.store_action = store_action
+      self.poll_action = poll_action
+      self.timeout = timeout
+      self.name = name
+      self.flusher = flusher
+      self.delta = delta
+      self.keyframe_interval = keyframe_interval
+      self.delta_ignore = delta_ignore if delta_ignore is not None else ['age']
+      # sensor id -> the row of its last reading
+      self.last = None
+      self.keyframe_polls = 0
+      self.spool = spool
 
    def partition(self):
       timestamp = datetime.utcnow()
@@ -77,14 +576,141 @@ class Collector:
          self.store()
       self.partition_no = timestamp.minute // self.partition_interval
       self.partition_start = datetime(timestamp.year,timestamp.month,timestamp.day,timestamp.hour,self.partition_no * self.partition_interval,tzinfo=timestamp.tzinfo)
-      self.data = []
+      self.data = PartitionBuffer()
+      # each partition starts with a keyframe
+      self.last = None
 
    def stop(self):
       self.collecting = False
       self.store()
 
+   def poll(self,session=requests):
+      """
+      Requests the data and returns the parsed response or None if the request
+      failed.
+      """
+      try:
+         response = session.get(self.url,timeout=self.timeout)
+      except requests.exceptions.RequestException as e:
+         print('{url} : {error}'.format(url=self.url,error=str(e)),file=sys.stderr,flush=True)
+         return None
+      if response.status_code!=200:
+         print('({status}) {text}'.format(status=response.status_code,text=response.text),file=sys.stderr,flush=True)
+         return None
+
+      try:
+         return response.json()
+      except json.decoder.JSONDecodeError as e:
+         print('{line}:{column} {msg}'.format(line=e.lineno,column=e.colno,msg=e.msg),file=sys.stderr)
+         print(response.text,file=sys.stderr,flush=True)
+         print('Attempting to patch JSON response...',file=sys.stderr,flush=True)
+         fixed = response.text.replace('"data":[],','"data":[')
+         try:
+            current_data = json.loads(fixed)
+         except json.decoder.JSONDecodeError as e:
+            print('Unsuccessful!',file=sys.stderr,flush=True)
+            return None
+         print('Patched!',file=sys.stderr,flush=True)
+         return current_data
+
+   def receive(self,current_data):
+      """
+      Adds the rows of a poll response to the current partition.
+      """
+
+      # check for a partition, check to make sure we haven't changed partitions before we add data
+      self.partition()
+
+      timestamp = datetime.utcnow().isoformat()
+      if self.verbose:
+         print('{name}{timestamp} : {count}'.format(name=self.name + ' ' if self.name is not None else '',timestamp=timestamp,count=current_data.get('count',0)),flush=True)
+
+      # store the headers
+      if self.headers is None:
+         self.headers = current_data['fields'].copy()
+         self.headers.insert(0,self.datetime_header)
+         if self.delta:
+            self.headers.append('delta')
+
+      if 'data' in current_data:
+         rows = current_data['data']
+         if rows is not None:
+            if self.delta:
+               rows = self.changed(current_data['fields'],rows)
+
+            # add the rows of data with the timestamp kept once for the poll
+            self.data.append(timestamp,rows)
+            if self.spool is not None:
+               self.spool.append(self.partition_start,self.headers,timestamp,rows)
+
+            # the poll as a micro-batch in the partition format
+            if self.poll_action is not None:
+               self.poll_action(self.partition_start,[self.headers] + [[timestamp] + row for row in rows])
+
+   def changed(self,fields,rows):
+      """
+      Returns the rows of a poll whose readings differ from the last
+      recorded reading of the sensor (ignoring the delta_ignore fields) with
+      'D' appended or, for a keyframe, all the rows with 'K' appended. A
+      keyframe starts each partition and then every keyframe_interval polls.
+      A sensor that is no longer reported repeats its last reading with 'R'
+      appended (readers skip these rows, see reader.without_removed). A poll
+      without any changes records its first row with 'N' appended (also
+      skipped by readers) so that the poll's timestamp is kept.
+      """
+      id_position = fields.index('ID') if 'ID' in fields else 0
+      compared = [position for position, field in enumerate(fields) if field not in self.delta_ignore]
+      def values(row):
+         return tuple(row[position] for position in compared if position < len(row))
+      keyframe = self.last is None or self.keyframe_polls >= self.keyframe_interval
+      previous = {} if keyframe else self.last
+      if keyframe:
+         self.keyframe_polls = 0
+      self.keyframe_polls += 1
+      # sensor id -> the last recorded row
+      self.last = {}
+      changed = []
+      for row in rows:
+         id = row[id_position]
+         last = previous.pop(id,None)
+         if keyframe or last is None or values(last)!=values(row):
+            changed.append(row + ['K' if keyframe else 'D'])
+         self.last[id] = row
+      for row in previous.values():
+         changed.append(row + ['R'])
+      if len(changed)==0 and len(rows)>0:
+         changed.append(rows[0] + ['N'])
+      return changed
+
+   def recover(self):
+      """
+      Restores the polls of the partitions in the spool that were not stored
+      (e.g., after a crash). The current partition continues to be collected
+      and any earlier partition is stored.
+      """
+      if self.spool is None:
+         return
+      timestamp = datetime.utcnow()
+      partition_no = timestamp.minute // self.partition_interval
+      current_start = datetime(timestamp.year,timestamp.month,timestamp.day,timestamp.hour,partition_no * self.partition_interval,tzinfo=timestamp.tzinfo)
+      for start, path in self.spool.segments():
+         headers, polls = self.spool.read(path)
+         if headers is not None:
+            self.headers = headers
+         self.partition_start = start
+         self.data = PartitionBuffer()
+         for poll_timestamp, rows in polls:
+            self.data.append(poll_timestamp,rows)
+         if self.verbose:
+            print('Recovered {count} rows for {start}'.format(count=len(self.data),start=start.isoformat()),flush=True)
+         if start==current_start:
+            self.partition_no = partition_no
+         else:
+            self.store()
+
    def collect(self):
 
+      self.recover()
       self.collecting = True
 
       def pause():
@@ -96,62 +722,89 @@ class Collector:
          self.partition()
 
          # request the data
-         response = requests.get(self.url)
-         if response.status_code!=200:
-            print('({status}) {text}'.format(status=response.status_code,text=response.text),file=sys.stderr,flush=True)
-            pause()
-            continue
+         current_data = self.poll()
+         if current_data is not None:
+            self.receive(current_data)
 
-         try:
-            current_data = response.json()
-         except json.decoder.JSONDecodeError as e:
-            print('{line}:{column} {msg}'.format(line=e.lineno,column=e.colno,msg=e.msg),file=sys.stderr)
-            print(response.text,file=sys.stderr,flush=True)
-            print('Attempting to patch JSON response...',file=sys.stderr,flush=True)
-            fixed = response.text.replace('"data":[],','"data":[')
-            try:
-               current_data = json.loads(fixed)
-            except json.decoder.JSONDecodeError as e:
-               print('Unsuccessful!',file=sys.stderr,flush=True)
-               pause()
-               continue
-            print('Patched!',file=sys.stderr,flush=True)
-
-         # check for a partition, check to make sure we haven't changed partitions before we add data
-         self.partition()
+         # pause for the interval
+         pause()
 
-         timestamp = datetime.utcnow().isoformat()
-         if self.verbose:
-            print('{timestamp} : {count}'.format(timestamp=timestamp,count=current_data.get('count',0)),flush=True)
+   async def collect_async(self,session=None):
+      """
+      Polls on a fixed wall-clock cadence: each poll starts at the next
+      multiple of the interval since the epoch regardless of how long the
+      previous request took. A poll that overruns its slot skips the missed
+      ticks. The blocking request runs in the default executor over a
+      session that reuses its connections, as do the storing of a finished
+      partition (which may wait for the flush queue) and the poll actions, so
+      that a slow store or poll action does not stall the other collectors.
+      """
+
+      self.recover()
+      self.collecting = True
+      session = session if session is not None else requests.Session()
+      loop = asyncio.get_running_loop()
 
-         # store the headers
-         if self.headers is None:
-            self.headers = current_data['fields'].copy()
-            self.headers.insert(0,self.datetime_header)
+      while self.collecting:
 
-         if 'data' in current_data:
-            rows = current_data['data']
-            if rows is not None:
-               # add the rows of data
-               for row in rows:
-                  # add the timestamp
-                  row.insert(0,timestamp)
-                  self.data.append(row)
+         await asyncio.sleep(next_tick(self.interval) - time.time())
+         if not self.collecting:
+            break
 
+         # check for a partition, commit early in case we changed partitions after the pause
+         await loop.run_in_executor(None,self.partition)
 
-         # pause for the interval
-         pause()
+         # request the data
+         current_data = await loop.run_in_executor(None,self.poll,session)
+         if current_data is not None and self.collecting:
+            await loop.run_in_executor(None,self.receive,current_data)
 
    def store(self):
       if self.data is None:
          return
 
-      if self.headers is not None:
-         self.data.insert(0,self.headers)
-
-      self.store_action(self.partition_start,self.data)
+      self.data.headers = self.headers
+
+      # the spool segment is removed once the partition is stored
+      start = self.partition_start
+      def done():
+         if self.spool is not None:
+            self.spool.remove(start)
+
+      if self.store_action is not None:
+         # the rows are only materialized for store actions that do not accept a PartitionBuffer
+         data = self.data if getattr(self.store_action,'buffered',False) else self.data.to_rows()
+         if self.flusher is not None:
+            self.flusher.submit(self.store_action,start,data,done=done)
+         else:
+            self.store_action(start,data)
+            done()
+      else:
+         done()
       self.data = None
 
+def next_tick(interval,now=None):
+   """
+   Returns the next wall-clock time (seconds since the epoch) that is a
+   multiple of the interval.
+   """
+   now = time.time() if now is None else now
+   return (now // interval + 1) * interval
+
+async def collect_all(collectors):
+   """
+   Runs the collectors concurrently in one event loop. Each collector has its
+   own session, partition buffer, and store action.
+   """
+   await asyncio.gather(*[collector.collect_async() for collector in collectors])
+
+def region_url(url,box,box_params,fields):
+   connector = '?' if url.find('?')<0 else '&'
+   for param,value in zip(box_params,box):
+      url += connector + param + '=' + value
+      connector = '&'
+   return url + connector + 'fields=' + fields
+
 if __name__ == '__main__':
 
    argparser = argparse.ArgumentParser(description='collect-aq')
@@ -164,6 +817,30 @@ if __name__ == '__main__':
    argparser.add_argument('--bounding-box-parameters',help='The bounding box parameter names',default='nwlat,nwlng,selat,selng')
    argparser.add_argument('--fields',help='The fields to record',default='pm_0,pm_1,pm_2,pm_3,pm_4,pm_5,pm_6')
    argparser.add_argument('--datetime-header',help='The name of the datetime header column',default='timestamp')
+   argparser.add_argument('--timeout',help='The request timeout (seconds)',type=float,default=30)
+   argparser.add_argument('--async',dest='use_async',help='Poll on a fixed wall-clock cadence with asyncio',action='store_true',default=False)
+   argparser.add_argument('--region',help='A named region to collect concurrently (name=nwlat,nwlon,selat,selon or name=url), may be repeated',action='append')
+
+   argparser.add_argument('--delta',help='Only record the readings that changed since the last poll (with periodic keyframes)',action='store_true',default=False)
+   argparser.add_argument('--keyframe-interval',help='The number of polls between keyframes that record every reading',type=int,default=10)
+   argparser.add_argument('--format',help='The format of the stored partitions',choices=list(formats.keys()),default='json')
+   argparser.add_argument('--compress',help='Compress the stored partitions',choices=['gzip','zstd'])
+   argparser.add_argument('--spool',help='A directory for a write-ahead log of the polls of unstored partitions (recovered on restart)')
+   argparser.add_argument('--spool-fsync',help='The minimum number of seconds between syncs of the spool to disk (0 syncs every poll)',type=float,default=0)
+   argparser.add_argument('--flush-queue',help='The number of partitions that may wait to be stored in the background (0 stores them inline)',type=int,default=4)
+   argparser.add_argument('--flush-retries',help='The number of times a failed store is retried',type=int,default=5)
+   argparser.add_argument('--flush-backoff',help='The initial delay (seconds) between retries, doubled on each retry',type=float,default=1.0)
+   argparser.add_argument('--multipart-threshold',help='The partition size (MB) at which S3 uploads are multipart',type=float,default=8)
+   argparser.add_argument('--stream',help='Write each poll to stdout as a record (e.g., for ingest.py --type stream)',action='store_true',default=False)
+
+   argparser.add_argument('--redis',help='Ingest each poll directly into Redis (host:port)')
+   argparser.add_argument('--redis-password',help='The Redis password')
+   argparser.add_argument('--redis-cluster',help='Connect to a Redis Cluster',action='store_true',default=False)
+   argparser.add_argument('--key-prefix',help='The Redis key prefix (defaults to AQI30- or AQI30B- for binary members)')
+   argparser.add_argument('--precision',help='Round the measurements ingested into Redis to the precision',type=int)
+   argparser.add_argument('--encoding',help='The member encoding for Redis',choices=['text','binary'],default='text')
+   argparser.add_argument('--shard-size',help='Split the Redis partitions into per-cell keys of quadrangles of this size (degrees)',type=float)
+   argparser.add_argument('--group-size',help='Group members by partition key into GEOADD commands of this size',type=int,default=500)
 
    argparser.add_argument('--dir',help='The directory in which to store the data')
 
@@ -179,35 +856,74 @@ if __name__ == '__main__':
       print('You cannot specify an S3 bucket and directory at the same time.',file=sys.stderr)
       sys.exit(1)
 
-   url = args.url
-
    if 60 % args.partition:
       print('The partition {} is not a divisor of 60'.format(args.partition))
       sys.exit(1)
 
    box_params = args.bounding_box_parameters.split(',')
-   box = args.bounding_box.split(',')
-
-   connector = '?'
-
-   for param,value in zip(box_params,box):
-      url += connector + param + '=' + value
-      connector = '&'
-
-   url += '&fields=' + args.fields
-
-   store_action = dump_storage
-   if args.s3_bucket is not None:
-      store_action = create_s3_storage_action(args.s3_bucket,verbose=args.verbose,endpoint=args.s3_endpoint,key=args.s3_key,secret=args.s3_secret,prefix=args.prefix)
-
-   if args.dir is not None:
-      store_action = create_dir_action(args.dir,prefix=args.prefix)
 
-   data_collector = Collector(url,interval=args.interval,partition_interval=args.partition,datetime_header=args.datetime_header,verbose=args.verbose,store_action=store_action)
+   # (name, url) of each region
+   regions = []
+   if args.region is None:
+      regions.append((None,region_url(args.url,args.bounding_box.split(','),box_params,args.fields)))
+   else:
+      for region in args.region:
+         name, _, spec = region.partition('=')
+         if len(name)==0 or len(spec)==0:
+            print('Invalid region: '+region,file=sys.stderr)
+            sys.exit(1)
+         if spec.startswith('http://') or spec.startswith('https://'):
+            regions.append((name,spec))
+         else:
+            box = spec.split(',')
+            if len(box)!=4:
+               print('Incorrect number of points in region box: '+region,file=sys.stderr)
+               sys.exit(1)
+            regions.append((name,region_url(args.url,box,box_params,args.fields)))
+
+   redis_action = None
+   if args.redis is not None:
+      import redis
+      host, _, port = args.redis.partition(':')
+      port = int(port) if len(port)>0 else 6379
+      if args.redis_password is None and 'REDIS_PASSWORD' in os.environ:
+         args.redis_password = os.environ['REDIS_PASSWORD']
+      if args.redis_cluster:
+         client = redis.RedisCluster(host=host,port=port,password=args.redis_password)
+      else:
+         client = redis.Redis(host=host,port=port,password=args.redis_password)
+      if args.key_prefix is None:
+         args.key_prefix = 'AQI30B-' if args.encoding=='binary' else 'AQI30-'
+      redis_action = create_redis_action(client,prefix=args.key_prefix,partition=args.partition,precision=args.precision,encoding=args.encoding,shard_size=args.shard_size,group_size=args.group_size,verbose=args.verbose)
+
+   # one flusher for all the regions so that stdout is written by a single thread
+   flusher = Flusher(queue_size=args.flush_queue,retries=args.flush_retries,backoff=args.flush_backoff,verbose=args.verbose) if args.flush_queue>0 else None
+
+   collectors = []
+   for name, url in regions:
+
+      # each named region is stored under its own prefix
+      prefix = args.prefix if name is None else args.prefix + name + '-'
+
+      # the polls are already on stdout when streaming or in Redis
+      store_action = None if args.stream or redis_action is not None else dump_storage
+      if args.s3_bucket is not None:
+         store_action = create_s3_storage_action(args.s3_bucket,verbose=args.verbose,endpoint=args.s3_endpoint,key=args.s3_key,secret=args.s3_secret,prefix=prefix,multipart_threshold=int(args.multipart_threshold*1024*1024),compression=args.compress,format=args.format)
+
+      if args.dir is not None:
+         store_action = create_dir_action(args.dir,prefix=prefix,compression=args.compress,format=args.format)
+
+      collectors.append(Collector(url,interval=args.interval,partition_interval=args.partition,datetime_header=args.datetime_header,verbose=args.verbose,store_action=store_action,poll_action=poll_actions([dump_storage if args.stream else None,redis_action]),timeout=args.timeout,name=name,flusher=flusher,delta=args.delta,keyframe_interval=args.keyframe_interval,spool=Spool(args.spool,name=name if name is not None else 'collect',fsync_interval=args.spool_fsync) if args.spool is not None else None))
 
    def interupt_handler(sig, frame):
-      data_collector.stop()
+      for data_collector in collectors:
+         data_collector.stop()
+      if flusher is not None:
+         flusher.close()
       sys.exit(0)
    signal.signal(signal.SIGINT, interupt_handler)
 
-   data_collector.collect()
+   if args.use_async or len(collectors)>1:
+      asyncio.run(collect_all(collectors))
+   else:
+      collectors[0].collect()
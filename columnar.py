@@ -0,0 +1,221 @@
+import json
+import mmap
+import struct
+import numpy as np
+
+# A columnar partition is:
+#
+#   magic (4 bytes) 'AQIC', version (uint8), 3 bytes padding, header length (uint32 LE)
+#   header (UTF-8 JSON)
+#   arrays (little-endian, each aligned to 8 bytes from the start of the file)
+#
+# The header lists the fields in their original order, the number of rows,
+# the arrays (dtype, offset, count), and how each field is stored:
+#
+#   {"type":"array","array":name} - a typed array with a value per row
+#   {"type":"dictionary","codes":name,"values":[...]} - codes into a list of JSON values
+#   {"type":"dictionary","codes":name,"array":name} - codes into a typed array
+#
+# The timestamp is a dictionary of the poll times (one per poll), the ID, Lat,
+# and Lon fields share the sensor codes into per-sensor arrays, the PM fields
+# are float32 arrays (NaN for null), and any other field is an integer or
+# float array when its values allow it or otherwise a dictionary.
+
+MAGIC = b'AQIC'
+VERSION = 1
+suffix = '.aqc'
+
+_preamble = struct.Struct('<4sBxxxI')
+_alignment = 8
+
+# the fields that share the sensor dictionary
+sensor_fields = ['ID','Lat','Lon']
+
+def is_columnar(data):
+   """
+   Returns True if the bytes start with the columnar partition magic number.
+   """
+   return data[:len(MAGIC)]==MAGIC
+
+def _codes_dtype(count):
+   if count <= 1<<8:
+      return np.dtype('<u1')
+   if count <= 1<<16:
+      return np.dtype('<u2')
+   return np.dtype('<u4')
+
+def _dictionary(values):
+   """
+   Returns the distinct values (in order of appearance) and the codes of the values.
+   """
+   # keyed by type so that 1, 1.0, and True remain distinct
+   index = {}
+   codes = [index.setdefault((type(value),value),len(index)) for value in values]
+   return [value for _, value in index.keys()], np.array(codes,dtype=_codes_dtype(len(index)))
+
+def _float_array(values,dtype):
+   return np.array([np.nan if value is None else value for value in values],dtype=dtype)
+
+def encode(rows):
+   """
+   Encodes a partition (the header row followed by the data rows) as a
+   columnar partition and returns the bytes.
+   """
+   data = rows[1:]
+   return encode_columns(rows[0],list(zip(*data)) if len(data)>0 else [()]*len(rows[0]),len(data))
+
+def encode_columns(headers,columns,length):
+   """
+   Encodes a partition given as the headers and a sequence of values for
+   each field as a columnar partition and returns the bytes.
+   """
+   headers = list(headers)
+
+   arrays = {}
+   fields = {}
+
+   sensors = all(field in headers for field in sensor_fields) and all(type(value)==int for value in columns[headers.index('ID')])
+   if sensors:
+      keyed = list(zip(*[columns[headers.index(field)] for field in sensor_fields]))
+      distinct, codes = _dictionary(keyed)
+      arrays['sensor'] = codes
+      distinct = list(zip(*distinct)) if len(distinct)>0 else [()]*len(sensor_fields)
+      arrays['sensor.ID'] = np.array(distinct[0],dtype='<i8')
+      arrays['sensor.Lat'] = _float_array(distinct[1],'<f8')
+      arrays['sensor.Lon'] = _float_array(distinct[2],'<f8')
+      for field in sensor_fields:
+         fields[field] = {'type':'dictionary','codes':'sensor','array':'sensor.'+field}
+
+   for position, field in enumerate(headers):
+      if field in fields:
+         continue
+      values = columns[position]
+      if field.startswith('pm_') and all(value is None or type(value) in (int,float) for value in values):
+         arrays[field] = _float_array(values,'<f4')
+         fields[field] = {'type':'array','array':field}
+      elif len(values)>0 and all(type(value)==int for value in values) and all(-2**31 <= value < 2**31 for value in values):
+         arrays[field] = np.array(values,dtype='<i4')
+         fields[field] = {'type':'array','array':field}
+      elif len(values)>0 and all(type(value)==float for value in values):
+         arrays[field] = np.array(values,dtype='<f8')
+         fields[field] = {'type':'array','array':field}
+      else:
+         distinct, codes = _dictionary(values)
+         arrays[field] = codes
+         fields[field] = {'type':'dictionary','codes':field,'values':distinct}
+
+   header = {
+      'version' : VERSION,
+      'fields' : headers,
+      'rows' : length,
+      'encoding' : fields,
+      'arrays' : {}
+   }
+
+   # the offsets depend on the header length which depends on the offsets
+   def layout(start):
+      offset = start
+      for name, array in arrays.items():
+         offset += -offset % _alignment
+         header['arrays'][name] = {'dtype':array.dtype.str,'offset':offset,'count':len(array)}
+         offset += array.nbytes
+      return json.dumps(header).encode('utf-8')
+
+   encoded = layout(_preamble.size)
+   while True:
+      start = _preamble.size + len(encoded)
+      relaid = layout(start)
+      if len(relaid)==len(encoded):
+         encoded = relaid
+         break
+      encoded = relaid
+
+   output = bytearray(_preamble.pack(MAGIC,VERSION,len(encoded)))
+   output += encoded
+   for name, array in arrays.items():
+      output += b'\0' * (header['arrays'][name]['offset'] - len(output))
+      output += array.tobytes()
+   return bytes(output)
+
+def float32_values(values):
+   """
+   Returns float32 values as float64 values of the shortest decimals that
+   round trip (e.g., 34.7 rather than 34.70000076293945), which are the
+   values that were encoded.
+   """
+   values = np.asarray(values)
+   wide = values.astype(np.float64)
+   result = wide.copy()
+   pending = ~np.isnan(wide) & ~np.isinf(wide)
+   for decimals in range(9):
+      if not pending.any():
+         return result
+      positions = np.flatnonzero(pending)
+      candidate = np.round(wide[positions],decimals)
+      matched = candidate.astype(np.float32)==values[positions]
+      result[positions[matched]] = candidate[matched]
+      pending[positions[matched]] = False
+   if pending.any():
+      result[pending] = values[pending].astype('U').astype(np.float64)
+   return result
+
+class ColumnarPartition:
+   """
+   A read-only view of a columnar partition over bytes or a memory map. The
+   arrays are views of the buffer and are not copied.
+   """
+   def __init__(self,buffer):
+      magic, version, length = _preamble.unpack_from(buffer,0)
+      if magic!=MAGIC:
+         raise ValueError('Not a columnar partition')
+      if version!=VERSION:
+         raise ValueError('Unsupported columnar partition version {}'.format(version))
+      self.buffer = buffer
+      self.header = json.loads(bytes(buffer[_preamble.size:_preamble.size + length]).decode('utf-8'))
+      self.fields = self.header['fields']
+      self.encoding = self.header['encoding']
+
+   @classmethod
+   def open(cls,path):
+      """
+      Memory maps a columnar partition file.
+      """
+      with open(path,'rb') as input:
+         return cls(mmap.mmap(input.fileno(),0,access=mmap.ACCESS_READ))
+
+   def __len__(self):
+      return self.header['rows']
+
+   def array(self,name):
+      info = self.header['arrays'][name]
+      return np.frombuffer(self.buffer,dtype=np.dtype(info['dtype']),count=info['count'],offset=info['offset'])
+
+   def column(self,field,start=0,end=None):
+      """
+      Returns the values of a field for the rows [start,end) as an array. The
+      PM fields are float64 with NaN for null values.
+      """
+      encoding = self.encoding[field]
+      if encoding['type']=='array':
+         values = self.array(encoding['array'])[start:end]
+         return float32_values(values) if values.dtype==np.float32 else values
+      codes = self.array(encoding['codes'])[start:end]
+      if 'array' in encoding:
+         return self.array(encoding['array'])[codes]
+      return np.array(encoding['values'] + [None],dtype=object)[:-1][codes]
+
+   def rows(self,chunk_size=10000):
+      """
+      Iterates the partition as rows (the header row followed by the data
+      rows) as they were encoded.
+      """
+      yield list(self.fields)
+      for start in range(0,len(self),chunk_size):
+         end = min(start + chunk_size,len(self))
+         columns = []
+         for field in self.fields:
+            values = self.column(field,start,end)
+            if values.dtype.kind=='f':
+               values = np.where(np.isnan(values),None,values.astype(object))
+            columns.append(values.tolist())
+         yield from map(list,zip(*columns))
@@ -1,5 +1,10 @@
-from haversine import haversine, Unit
-from math import floor
+from math import floor, cos, sin, asin, sqrt, radians, degrees
+import numpy as np
+from itertools import chain
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from redis.exceptions import ResponseError
+from members import datetime_score, decode_member
 
 def sequence_number(size,p):
    λ, ϕ = p
@@ -28,6 +33,50 @@ def quadrangle_for_sequence_number(size,s):
    se = (nw[0] - λ_s, nw[1] + φ_s)
    return [nw,se]
 
+def sequence_numbers(size,lat,lon):
+   """
+   Returns the sequence numbers of the quadrangles that contain the points
+   as an int64 array (the same as sequence_number for each point).
+
+   Arguments:
+   size - the size of the quadrangles
+   lat - an array of latitudes
+   lon - an array of longitudes
+   """
+   λ_s, φ_s = size if type(size)==tuple else (size,size)
+   λ = np.asarray(lat,dtype=np.float64)
+   ϕ = np.asarray(lon,dtype=np.float64)
+
+   λ_p = 90 - λ
+   φ_p = np.where(ϕ < 0, 360 + ϕ, ϕ)
+
+   s = np.floor(λ_p / λ_s) * floor(360.0 / φ_s) + np.floor(φ_p / φ_s) + 1
+
+   return s.astype(np.int64)
+
+def quadrangles_for_sequence_numbers(size,s):
+   """
+   Returns the quadrangles of the sequence numbers as an array of shape
+   (n,2,2) of [nw,se] (the same as quadrangle_for_sequence_number for each
+   sequence number).
+
+   Arguments:
+   size - the size of the quadrangles
+   s - an array of sequence numbers
+   """
+   λ_s, φ_s = size if type(size)==tuple else (size,size)
+
+   N_λ, N_φ = sequence_partitions(size)
+
+   z = (np.asarray(s,dtype=np.int64) - 1) % (N_λ * N_φ)
+   φ_p = (z % N_φ) * φ_s
+   quadrangles = np.empty((len(z),2,2),dtype=np.float64)
+   quadrangles[:,0,0] = 90 - np.floor(z / N_φ) * λ_s
+   quadrangles[:,0,1] = np.where(φ_p > 180, φ_p - 360, φ_p)
+   quadrangles[:,1,0] = quadrangles[:,0,0] - λ_s
+   quadrangles[:,1,1] = quadrangles[:,0,1] + φ_s
+   return quadrangles
+
 def is_valid_datetime_partition(partition,t):
    if t.second!=0 or \
       t.microsecond!=0 or \
@@ -64,6 +113,117 @@ def sequence_numbers_for_bounds(size,*args):
          current += 1
       current = row_start + N_φ
 
+def sequence_number_array_for_bounds(size,*args):
+   """
+   Returns the sequence numbers of the quadrangles that cover the bounds as
+   an int64 array in the order of sequence_numbers_for_bounds (including
+   the split of bounds that cross longitude 0).
+   """
+   if len(args)==1:
+      nw = args[0][0]
+      se = args[0][1]
+   elif len(args)==2:
+      nw = args[0]
+      se = args[1]
+   else:
+      raise ValueError('Too many arguments after client and key: '+str(len(args)))
+   p = 0.00000000001
+   s_nw, s_ne, s_se = sequence_numbers(size,[nw[0],nw[0],se[0]-p],[nw[1],se[1]-p,se[1]-p]).tolist()
+   if s_ne < s_nw:
+      return np.concatenate([
+         sequence_number_array_for_bounds(size,nw,(se[0],-p)),
+         sequence_number_array_for_bounds(size,(nw[0],p),se)
+      ])
+   width = s_ne - s_nw + 1
+   N_λ, N_φ = sequence_partitions(size)
+   rows = max((s_se - s_nw) // N_φ + 1,0)
+   return (s_nw + np.arange(rows,dtype=np.int64)[:,None] * N_φ + np.arange(width,dtype=np.int64)[None,:]).ravel()
+
+def adaptive_covering(*args,max_cells=16,min_size=0.125,max_size=4.0):
+   """
+   Returns a covering of the bounds by at most max_cells quadrangles of
+   mixed sizes as a list of (size, sequence number) ordered from the north
+   west. The sizes are max_size halved until min_size and the quadrangles of
+   a size are the sequence number quadrangles of that size where each one
+   is exactly divided into four of the next size (i.e., a quad-tree).
+
+   The covering starts with the finest size whose covering fits in
+   max_cells (or max_size) and then repeatedly divides the quadrangle with
+   the most area outside the bounds while the covering still fits.
+
+   Arguments:
+   bounds - the bounds as an array of [nw,se]
+   - or -
+   nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
+   se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   max_cells - the maximum number of quadrangles (unless the covering at max_size is larger)
+   min_size - the smallest quadrangle size
+   max_size - the largest quadrangle size (a power of two multiple of min_size)
+   """
+   if len(args)==1:
+      nw = args[0][0]
+      se = args[0][1]
+   elif len(args)==2:
+      nw = args[0]
+      se = args[1]
+   else:
+      raise ValueError('Too many arguments after client and key: '+str(len(args)))
+
+   sizes = [max_size]
+   while sizes[-1]/2 >= min_size:
+      sizes.append(sizes[-1]/2)
+
+   size = sizes[0]
+   numbers = list(sequence_numbers_for_bounds(size,nw,se))
+   for finer in sizes[1:]:
+      finer_numbers = sequence_number_array_for_bounds(finer,nw,se)
+      if len(finer_numbers) > max_cells:
+         break
+      size, numbers = finer, finer_numbers.tolist()
+
+   def intersection(q_nw,q_se):
+      lat_size = min(nw[0],q_nw[0]) - max(se[0],q_se[0])
+      lon_size = min(se[1],q_se[1]) - max(nw[1],q_nw[1])
+      return lat_size*lon_size if lat_size > 0 and lon_size > 0 else 0
+
+   def waste(size,q_nw,q_se):
+      return size*size - intersection(q_nw,q_se)
+
+   covering = set()
+   # (-waste, size, sequence number) of the quadrangles that may be divided
+   candidates = []
+   for number in numbers:
+      covering.add((size,number))
+      q_nw, q_se = quadrangle_for_sequence_number(size,number)
+      heapq.heappush(candidates,(-waste(size,q_nw,q_se),size,number))
+
+   while len(candidates)>0:
+      wasted, size, number = heapq.heappop(candidates)
+      half = size/2
+      if wasted==0 or half < min_size:
+         continue
+      q_nw, q_se = quadrangle_for_sequence_number(size,number)
+      children = []
+      for i in range(2):
+         for j in range(2):
+            c_nw = (q_nw[0] - i*half, q_nw[1] + j*half)
+            c_se = (c_nw[0] - half, c_nw[1] + half)
+            if intersection(c_nw,c_se) > 0:
+               # the sequence number of the center of the child
+               children.append((half,sequence_number(half,(c_nw[0] - half/2, c_nw[1] + half/2)),c_nw,c_se))
+      if len(covering) - 1 + len(children) > max_cells:
+         continue
+      covering.remove((size,number))
+      for child_size, child, c_nw, c_se in children:
+         covering.add((child_size,child))
+         heapq.heappush(candidates,(-waste(child_size,c_nw,c_se),child_size,child))
+
+   def position(cell):
+      q_nw, _ = quadrangle_for_sequence_number(*cell)
+      return (-q_nw[0],q_nw[1],cell[0])
+
+   return sorted(covering,key=position)
+
 def quadrangles_for_bounds(size,*args):
    λ_s, φ_s = size if type(size)==tuple else (size,size)
    if len(args)==1:
@@ -119,15 +279,113 @@ def query_circle(client, partition_key, center, radius, unit='km', bounds=None):
       lon = pos[0]
 
       # check boundary
-      if bounds is not None and lat >= nw[0] or lat <= se[0] or lon <= nw[1] or lon >= se[1]:
+      if bounds is not None and (lat >= nw[0] or lat <= se[0] or lon <= nw[1] or lon >= se[1]):
          continue
 
       yield key, (lat,lon)
 
-def query_quadrangle(client, partition_key, *args):
+# the earth radius (meters) used by Redis for geospatial distances
+_redis_earth_radius = 6372797.560856
+
+def redis_distance(p1,p2):
+   """
+   Returns the distance (in km) between two positions (lat,lon) as Redis
+   computes it (the haversine distance on a sphere of the Redis Earth radius).
+   """
+   lat1, lon1, lat2, lon2 = map(radians,(p1[0],p1[1],p2[0],p2[1]))
+   h = sin((lat2 - lat1)/2)**2 + cos(lat1)*cos(lat2)*sin((lon2 - lon1)/2)**2
+   return 2 * _redis_earth_radius / 1000 * asin(min(sqrt(h),1.0))
+
+def inscribing_radius(center,nw,se):
+   """
+   Returns the radius (in km) of the circle about the center of a quadrangle
+   that contains the quadrangle. The corners closer to the equator are
+   farther from the center so both the north and south corners are measured.
+   """
+   return max(redis_distance(center,nw),redis_distance(center,(se[0],nw[1])))
+
+def box_search(nw,se):
+   """
+   Returns the GEOSEARCH arguments (for redis-py geosearch) of the box that
+   covers the quadrangle (see query_box).
+   """
+   lat_size = abs(nw[0] - se[0])
+   lon_size = abs(nw[1] - se[1])
+   center = (nw[0] - lat_size/2, nw[1] + lon_size/2)
+
+   nearest = 0 if se[0] <= 0 <= nw[0] else min(abs(nw[0]),abs(se[0]))
+   height = _redis_earth_radius * radians(lat_size)
+   width = 4 * _redis_earth_radius * asin(min(cos(radians(nearest)) * sin(radians(lon_size/4)),1))
+
+   # pad for rounding so that values on the edges are considered by the bounds check
+   return {'longitude':center[1],'latitude':center[0],'width':width*1.000001 + 1,'height':height*1.000001 + 1,'unit':'m','withcoord':True}
+
+def query_box(client, partition_key, nw, se):
+   """
+   Iterates the values that fall within the defined quadrangle for the
+   geospatial key via GEOSEARCH ... BYBOX (Redis 6.2 or later).
+
+   The height of the box is the latitude span. Redis measures the width at
+   the latitude of each point and so the width is the longitude span at the
+   latitude nearest the equator. The few extra values at the other corners
+   are removed by the bounds check.
+
+   Arguments:
+   client - the Redis client instance
+   partition_key - the geospatial set key
+   nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
+   se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   """
+   result = client.geosearch(partition_key,**box_search(nw,se))
+
+   for key, pos in result:
+
+      # Note: pos is lon, lat
+
+      lat = pos[1]
+      lon = pos[0]
+
+      # check boundary
+      if lat >= nw[0] or lat <= se[0] or lon <= nw[1] or lon >= se[1]:
+         continue
+
+      yield key, (lat,lon)
+
+# the servers known to be older than Redis 6.2 (see geosearch_supported)
+_geosearch_unsupported = set()
+
+def _server(client):
+   # the address of the server so that the clients of a server (e.g., one per request) share what is learned
+   pool = getattr(client,'connection_pool',None)
+   if pool is not None:
+      kwargs = pool.connection_kwargs
+      return (kwargs.get('host'),kwargs.get('port'),kwargs.get('path'))
+   if hasattr(client,'get_default_node'):
+      node = client.get_default_node()
+      return (node.host,node.port,None)
+   return id(client)
+
+def geosearch_supported(client):
+   """
+   Returns false when the client's server is known not to support GEOSEARCH
+   (older than Redis 6.2) or the client sets geosearch_supported to false.
+   """
+   return getattr(client,'geosearch_supported',True) and _server(client) not in _geosearch_unsupported
+
+def geosearch_unsupported(client):
+   """
+   Records that the client's server does not support GEOSEARCH so that
+   every client of the server uses the GEORADIUS fallback.
+   """
+   _geosearch_unsupported.add(_server(client))
+
+def query_quadrangle(client, partition_key, *args, by_box=True):
    """
    Iterates the values that fail within the defined quadrangle
-   for the geospatial key.
+   for the geospatial key. The quadrangle is queried as a box (see
+   query_box) unless the server does not support GEOSEARCH or by_box is
+   false, in which case the circle that inscribes the quadrangle is
+   queried and the values outside the quadrangle are removed.
 
    Arguments:
    client - the Redis client instance
@@ -136,6 +394,7 @@ def query_quadrangle(client, partition_key, *args):
    - or -
    nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
    se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   by_box - use GEOSEARCH when supported (defaults to True)
    """
 
    if len(args)==1:
@@ -147,16 +406,180 @@ def query_quadrangle(client, partition_key, *args):
    else:
       raise ValueError('Too many arguments after client and key: '+str(len(args)))
 
+   if by_box and geosearch_supported(client):
+      try:
+         # the command is sent when the generator is created so that an older server is detected here
+         result = query_box(client,partition_key,nw,se)
+         first = next(result,None)
+      except ResponseError as ex:
+         if 'unknown command' not in str(ex).lower():
+            raise
+         # remember that the server is older than Redis 6.2
+         geosearch_unsupported(client)
+      else:
+         return result if first is None else chain([first],result)
+
    lat_size = abs(nw[0] - se[0])
    lon_size = abs(nw[1] - se[1])
 
    # inscribe the quadrangle onto a circle with radius from center to
    center = (nw[0] - lat_size/2, nw[1] + lon_size/2)
-   radius = haversine(center,nw,unit=Unit.KILOMETERS)
+   # pad for rounding so that values on the corners are considered by the bounds check
+   radius = inscribing_radius(center,nw,se)*1.000001 + 0.001
 
    return query_circle(client,partition_key,center,radius,bounds=[nw,se])
 
-def query_region(client,partition_key,*args,size=0.5,by_quadrangles=False):
+# the margin (in degrees) around a shard's cell that covers the coordinates
+# of its values as quantized by Redis (well under a meter)
+_shard_margin = 0.00001
+
+def search_cells(client,cells,nw,se,by_box=True,batch_size=None,workers=1,sharded=False):
+   """
+   Iterates the (index, values) of each of the cells in order where the
+   values are the (member, (lat,lon)) in the cell (including its edges) that
+   fall within the quadrangle. The cell queries are sent in pipelines of
+   batch_size queries (all the queries by default) and, with more than one
+   worker, the pipelines are sent concurrently over the connection pool.
+
+   When the keys are shards (see shard_key), the key defines the cell: the
+   shard was chosen from the ingested position and Redis may store a value
+   on the edge just outside of the cell. The cell is searched with a small
+   margin and only the quadrangle is checked.
+
+   Arguments:
+   client - the Redis client instance
+   cells - the (key, nw, se) of each cell
+   nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
+   se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   by_box - use GEOSEARCH when supported (defaults to True)
+   batch_size - the number of cell queries per pipeline
+   workers - the number of pipelines sent concurrently
+   sharded - the keys are the shards of the cells
+   """
+   queries = []
+   for index, (key, q_nw, q_se) in enumerate(cells):
+      if sharded:
+         q_nw = (q_nw[0] + _shard_margin,q_nw[1] - _shard_margin)
+         q_se = (q_se[0] - _shard_margin,q_se[1] + _shard_margin)
+      i_nw = (min(nw[0],q_nw[0]),max(nw[1],q_nw[1]))
+      i_se = (max(se[0],q_se[0]),min(se[1],q_se[1]))
+      # the cell only touches the quadrangle
+      if i_nw[0] <= i_se[0] or i_nw[1] >= i_se[1]:
+         continue
+      queries.append((index,key,q_nw,q_se,i_nw,i_se))
+
+   def search(batch):
+      box = by_box and geosearch_supported(client)
+      pipe = client.pipeline(transaction=False)
+      for index, key, q_nw, q_se, i_nw, i_se in batch:
+         if box:
+            pipe.geosearch(key,**box_search(i_nw,i_se))
+         else:
+            lat_size = i_nw[0] - i_se[0]
+            lon_size = i_se[1] - i_nw[1]
+            center = (i_nw[0] - lat_size/2, i_nw[1] + lon_size/2)
+            # pad for rounding so that values on the corners are considered by the bounds check
+            radius = inscribing_radius(center,i_nw,i_se)
+            pipe.georadius(key,center[1],center[0],radius*1.000001 + 0.001,unit='km',withcoord=True)
+      results = pipe.execute(raise_on_error=False)
+      for result in results:
+         if isinstance(result,ResponseError):
+            if box and 'unknown command' in str(result).lower():
+               # remember that the server is older than Redis 6.2
+               geosearch_unsupported(client)
+               return search(batch)
+            raise result
+      return results
+
+   size = batch_size if batch_size is not None and batch_size>0 else max(len(queries),1)
+   batches = [queries[start:start + size] for start in range(0,len(queries),size)]
+   if workers>1 and len(batches)>1:
+      executor = ThreadPoolExecutor(max_workers=workers)
+      searched = executor.map(search,batches)
+   else:
+      executor = None
+      searched = map(search,batches)
+
+   next_index = 0
+   try:
+      for batch, results in zip(batches,searched):
+         for (index, key, q_nw, q_se, i_nw, i_se), result in zip(batch,results):
+            # the cells that were not queried
+            while next_index < index:
+               yield next_index, []
+               next_index += 1
+            values = []
+            for member, pos in result:
+
+               # Note: pos is lon, lat
+
+               lat = pos[1]
+               lon = pos[0]
+
+               # check the boundary of the cell (inclusive) and the quadrangle
+               if not sharded and (lat > q_nw[0] or lat < q_se[0] or lon < q_nw[1] or lon > q_se[1]):
+                  continue
+               if lat >= nw[0] or lat <= se[0] or lon <= nw[1] or lon >= se[1]:
+                  continue
+
+               values.append((member,(lat,lon)))
+            yield index, values
+            next_index = index + 1
+      while next_index < len(cells):
+         yield next_index, []
+         next_index += 1
+   finally:
+      if executor is not None:
+         executor.shutdown(wait=False)
+
+def query_cells(client,cells,nw,se,by_box=True,batch_size=None,workers=1,sharded=False):
+   """
+   Iterates the values that fall within the quadrangle from the cells that
+   cover it (see search_cells). The results are streamed in the order of
+   the cells.
+
+   Each cell is queried for its intersection with the quadrangle and
+   includes the values on its edges so that a value on an edge shared by
+   two cells is returned once.
+
+   Arguments:
+   client - the Redis client instance
+   cells - the (key, nw, se) of each cell
+   nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
+   se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   by_box - use GEOSEARCH when supported (defaults to True)
+   batch_size - the number of cell queries per pipeline
+   workers - the number of pipelines sent concurrently
+   sharded - the keys are the shards of the cells (see search_cells)
+   """
+   seen = set()
+   for _, values in search_cells(client,cells,nw,se,by_box=by_box,batch_size=batch_size,workers=workers,sharded=sharded):
+      for member, pos in values:
+         if member in seen:
+            continue
+         seen.add(member)
+         yield member, pos
+
+def query_region(client,partition_key,*args,size=0.5,by_quadrangles=False,shard_size=None,by_box=True,batch_size=None,workers=1,max_cells=None):
+   """
+   Iterates the values that fall within the defined quadrangle by querying
+   the quadrangles of the given size that cover it (see query_cells).
+
+   Arguments:
+   client - the Redis client instance
+   partition_key - the geospatial set key
+   bounds - the bounds as an array of [nw,se]
+   - or -
+   nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
+   se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   size - the size of the covering quadrangles
+   by_quadrangles - compute the covering with quadrangles_for_bounds rather than sequence numbers
+   max_cells - compute an adaptive covering of at most this many quadrangles (see adaptive_covering)
+   shard_size - the shard size when the partition was ingested as shards
+   by_box - use GEOSEARCH when supported (defaults to True)
+   batch_size - the number of cell queries per pipeline (defaults to all)
+   workers - the number of pipelines sent concurrently
+   """
    if len(args)==1:
       nw = args[0][0]
       se = args[0][1]
@@ -166,32 +589,255 @@ def query_region(client,partition_key,*args,size=0.5,by_quadrangles=False):
    else:
       raise ValueError('Too many arguments after client and key: '+str(len(args)))
 
-   if by_quadrangles:
-      for quadrangle in quadrangles_for_bounds(size,nw,se):
-         for key, pos in query_quadrangle(client,partition_key,quadrangle):
+   if shard_size is not None:
+      # the partition is stored as shards that can be queried directly
+      return query_shards(client,partition_key,shard_size,nw,se,by_box=by_box,batch_size=batch_size,workers=workers)
 
-            lat = pos[0]
-            lon = pos[1]
+   if max_cells is not None:
+      cells = [(partition_key,) + tuple(quadrangle_for_sequence_number(cell_size,number)) for cell_size, number in adaptive_covering(nw,se,max_cells=max_cells)]
+   elif by_quadrangles:
+      cells = [(partition_key,q_nw,q_se) for q_nw, q_se in quadrangles_for_bounds(size,nw,se)]
+   else:
+      cells = [(partition_key,(q_nw[0],q_nw[1]),(q_se[0],q_se[1])) for q_nw, q_se in quadrangles_for_sequence_numbers(size,sequence_number_array_for_bounds(size,nw,se)).tolist()]
 
-            # check boundary
-            if lat >= nw[0] or lat <= se[0] or lon <= nw[1] or lon >= se[1]:
-               #print(pos)
-               continue
+   return query_cells(client,cells,nw,se,by_box=by_box,batch_size=batch_size,workers=workers)
 
-            yield key, pos
+def shard_key(partition_key,size,sequence_number):
+   """
+   Returns the key of a cell in a spatially sharded partition. The sequence
+   number is the hash tag so that a cell is assigned to the same cluster slot
+   for every partition (e.g., AQI30-2020-09-10T11:30:00PT30M/0.5/{48361}).
+
+   Arguments:
+   partition_key - the geospatial set key of the whole partition
+   size - the size of the shard quadrangles
+   sequence_number - the sequence number of the quadrangle
+   """
+   return '{key}/{size}/{{{s}}}'.format(key=partition_key,size=float(size),s=sequence_number)
+
+def query_shards(client,partition_key,shard_size,*args,by_box=True,batch_size=None,workers=1):
+   """
+   Iterates the values that fall within the defined quadrangle for a
+   partition ingested as per-cell shard keys. Only the shards that cover the
+   quadrangle are queried (see query_cells).
+
+   Arguments:
+   client - the Redis client instance
+   partition_key - the geospatial set key of the whole partition
+   shard_size - the size of the shard quadrangles used at ingest
+   bounds - the bounds as an array of [nw,se]
+   - or -
+   nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
+   se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   by_box - use GEOSEARCH when supported (defaults to True)
+   batch_size - the number of shard queries per pipeline (defaults to all)
+   workers - the number of pipelines sent concurrently
+   """
+   if len(args)==1:
+      nw = args[0][0]
+      se = args[0][1]
+   elif len(args)==2:
+      nw = args[0]
+      se = args[1]
    else:
-      for sequence_number in sequence_numbers_for_bounds(size,nw,se):
+      raise ValueError('Too many arguments after client and key: '+str(len(args)))
 
-         q_nw, q_se = quadrangle_for_sequence_number(size,sequence_number)
+   numbers = sequence_number_array_for_bounds(shard_size,nw,se)
+   cells = [(shard_key(partition_key,shard_size,number),(q_nw[0],q_nw[1]),(q_se[0],q_se[1])) for number, (q_nw, q_se) in zip(numbers.tolist(),quadrangles_for_sequence_numbers(shard_size,numbers).tolist())]
 
-         for key, pos in query_quadrangle(client,partition_key,q_nw,q_se):
+   return query_cells(client,cells,nw,se,by_box=by_box,batch_size=batch_size,workers=workers,sharded=True)
 
-            lat = pos[0]
-            lon = pos[1]
+def aggregate_members(values):
+   """
+   Returns the count of the members and the mean and max of each of their
+   readings (None when there are no readings at the position).
 
-            # check boundary
-            if lat >= nw[0] or lat <= se[0] or lon <= nw[1] or lon >= se[1]:
-               #print(pos)
-               continue
+   Arguments:
+   values - the (member, (lat,lon)) of the members
+   """
+   count = 0
+   counts = []
+   sums = []
+   maxima = []
+   for member, _ in values:
+      _, _, readings = decode_member(member)
+      count += 1
+      for index, value in enumerate(readings):
+         if index==len(counts):
+            counts.append(0)
+            sums.append(0.0)
+            maxima.append(value)
+         counts[index] += 1
+         sums[index] += value
+         maxima[index] = max(maxima[index],value)
+   return {
+      'count' : count,
+      'mean' : [total / n if n>0 else None for total, n in zip(sums,counts)],
+      'max' : maxima
+   }
+
+def query_partitions(client,prefix,start,end,*args,duration='PT30M',size=0.5,shard_size=None,max_cells=None,by_box=True,batch_size=100,workers=1,aggregate=False):
+   """
+   Iterates the (partition, values) of each partition in the time range (in
+   order) where the values are the (member, (lat,lon)) that fall within the
+   defined quadrangle. The partitions are found in the partition set (e.g.,
+   AQI30-PT30M) and the cells of every partition are sent together in
+   pipelines of batch_size queries (see search_cells) so that the results
+   are streamed partition by partition.
 
+   Arguments:
+   client - the Redis client instance
+   prefix - the key prefix (e.g., AQI30-)
+   start - the start datetime of the range (inclusive)
+   end - the end datetime of the range (inclusive)
+   bounds - the bounds as an array of [nw,se]
+   - or -
+   nw - the north west corner of the quadrangle as a tuple/list (lat,lon)
+   se - the south east corner of the quadrangle as a tuple/list (lat,lon)
+   duration - the partition duration (e.g., PT30M or the rollups PT1H and P1D)
+   size - the size of the covering quadrangles
+   shard_size - the shard size when the partitions were ingested as shards
+   max_cells - compute an adaptive covering of at most this many quadrangles (see adaptive_covering)
+   by_box - use GEOSEARCH when supported (defaults to True)
+   batch_size - the number of cell queries per pipeline
+   workers - the number of pipelines sent concurrently
+   aggregate - the values are the count, mean, and max of the readings (see aggregate_members)
+   """
+   if len(args)==1:
+      nw = args[0][0]
+      se = args[0][1]
+   elif len(args)==2:
+      nw = args[0]
+      se = args[1]
+   else:
+      raise ValueError('Too many arguments after client and range: '+str(len(args)))
+
+   partitions = [key.decode('utf-8') for key in client.zrangebyscore(prefix + duration,datetime_score(start),datetime_score(end))]
+   if len(partitions)==0:
+      return
+
+   def result(values):
+      if aggregate:
+         return aggregate_members(values)
+      return values
+
+   # the same covering (or shards) for every partition
+   if shard_size is not None:
+      numbers = sequence_number_array_for_bounds(shard_size,nw,se).tolist()
+      covering = quadrangles_for_sequence_numbers(shard_size,np.array(numbers,dtype=np.int64)).tolist()
+      key_for = lambda key, number : shard_key(key,shard_size,number)
+   elif max_cells is not None:
+      numbers = adaptive_covering(nw,se,max_cells=max_cells)
+      covering = [quadrangle_for_sequence_number(cell_size,number) for cell_size, number in numbers]
+      key_for = lambda key, number : key
+   else:
+      numbers = sequence_number_array_for_bounds(size,nw,se).tolist()
+      covering = quadrangles_for_sequence_numbers(size,np.array(numbers,dtype=np.int64)).tolist()
+      key_for = lambda key, number : key
+   covering = [((q_nw[0],q_nw[1]),(q_se[0],q_se[1])) for q_nw, q_se in covering]
+   if len(covering)==0:
+      for key in partitions:
+         yield key[len(prefix):], result([])
+      return
+
+   cells = [(key_for(key,number),q_nw,q_se) for key in partitions for number, (q_nw, q_se) in zip(numbers,covering)]
+
+   current = 0
+   seen = set()
+   values = []
+   for index, cell_values in search_cells(client,cells,nw,se,by_box=by_box,batch_size=batch_size,workers=workers,sharded=shard_size is not None):
+      position = index // len(covering)
+      if position!=current:
+         yield partitions[current][len(prefix):], result(values)
+         current = position
+         seen = set()
+         values = []
+      for member, pos in cell_values:
+         if member in seen:
+            continue
+         seen.add(member)
+         values.append((member,pos))
+   yield partitions[current][len(prefix):], result(values)
+
+_km_per_unit = {'m' : 0.001, 'km' : 1.0, 'mi' : 1.609344, 'ft' : 0.0003048}
+
+def circle_bounds(center,radius,unit='km'):
+   """
+   Returns the bounds (nw,se) of the quadrangles that cover a circle as
+   Redis evaluates it. A circle that crosses the antimeridian is covered by
+   a quadrangle on each side and a circle that contains a pole covers every
+   longitude.
+
+   Arguments:
+   center - the center of the circle as a tuple/list (lat,lon)
+   radius - the radius of the circle
+   unit - the unit of measure for the radius (defaults to km)
+   """
+   # the angular radius on the sphere used by Redis
+   d = radius * _km_per_unit[unit] * 1000 / _redis_earth_radius
+   north = min(center[0] + degrees(d),90)
+   south = max(center[0] - degrees(d),-90)
+   if north==90 or south==-90 or sin(d) >= cos(radians(center[0])):
+      return [((north,-180),(south,180))]
+   lon_delta = degrees(asin(sin(d) / cos(radians(center[0]))))
+   west = center[1] - lon_delta
+   east = center[1] + lon_delta
+   if west < -180:
+      return [((north,west + 360),(south,180)),((north,-180),(south,east))]
+   if east > 180:
+      return [((north,west),(south,180)),((north,-180),(south,east - 360))]
+   return [((north,west),(south,east))]
+
+def query_shards_circle(client,partition_key,shard_size,center,radius,unit='km'):
+   """
+   Iterates the values that fall within the defined circle for a partition
+   ingested as per-cell shard keys. Only the shards that cover the bounding
+   quadrangles of the circle are queried (see circle_bounds).
+
+   Arguments:
+   client - the Redis client instance
+   partition_key - the geospatial set key of the whole partition
+   shard_size - the size of the shard quadrangles used at ingest
+   center - the center of the circle as a tuple/list (lat,lon)
+   radius - the radius of the circle
+   unit - the unit of measure for the radius (defaults to km)
+   """
+   for nw, se in circle_bounds(center,radius,unit=unit):
+      for sequence_number in sequence_numbers_for_bounds(shard_size,nw,se):
+         for key, pos in query_circle(client,shard_key(partition_key,shard_size,sequence_number),center,radius,unit=unit):
             yield key, pos
+
+if __name__ == '__main__':
+
+   import argparse
+   from timeit import timeit
+
+   argparser = argparse.ArgumentParser(description='A micro-benchmark of the scalar and vectorized sequence number functions')
+   argparser.add_argument('--size',help='The quadrangle size',type=float,default=0.5)
+   argparser.add_argument('--points',help='The number of random points',type=int,default=100000)
+   argparser.add_argument('--repeat',help='The number of times each function is timed',type=int,default=3)
+   argparser.add_argument('--bounds',help='The bounds of the covering (nwlat,nwlon,selat,selon)',default='50,-130,24,-60')
+   args = argparser.parse_args()
+
+   rng = np.random.default_rng(0)
+   lat = rng.uniform(-89.9,89.9,args.points)
+   lon = rng.uniform(-180,180,args.points)
+   points = list(zip(lat.tolist(),lon.tolist()))
+   numbers = sequence_numbers(args.size,lat,lon)
+   box = [float(value) for value in args.bounds.split(',')]
+   nw, se = (box[0],box[1]), (box[2],box[3])
+
+   # the vectorized results must be identical to the scalar results
+   assert [sequence_number(args.size,point) for point in points]==numbers.tolist()
+   assert [quadrangle_for_sequence_number(args.size,number) for number in numbers.tolist()]==[[tuple(nw_q),tuple(se_q)] for nw_q, se_q in quadrangles_for_sequence_numbers(args.size,numbers).tolist()]
+   assert list(sequence_numbers_for_bounds(args.size,nw,se))==sequence_number_array_for_bounds(args.size,nw,se).tolist()
+
+   def report(name,scalar,vector,count):
+      scalar_time = timeit(scalar,number=args.repeat) / args.repeat
+      vector_time = timeit(vector,number=args.repeat) / args.repeat
+      print('{name:<28} {count:>9} {scalar:10.4f}s {vector:10.4f}s {speedup:8.1f}x'.format(name=name,count=count,scalar=scalar_time,vector=vector_time,speedup=scalar_time / vector_time))
+
+   print('{name:<28} {count:>9} {scalar:>11} {vector:>11} {speedup:>9}'.format(name='function',count='count',scalar='scalar',vector='vector',speedup='speedup'))
+   report('sequence_number',lambda: [sequence_number(args.size,point) for point in points],lambda: sequence_numbers(args.size,lat,lon),args.points)
+   report('quadrangle_for_sequence',lambda: [quadrangle_for_sequence_number(args.size,number) for number in numbers.tolist()],lambda: quadrangles_for_sequence_numbers(args.size,numbers),args.points)
+   report('sequence_numbers_for_bounds',lambda: list(sequence_numbers_for_bounds(args.size,nw,se)),lambda: sequence_number_array_for_bounds(args.size,nw,se),len(sequence_number_array_for_bounds(args.size,nw,se)))
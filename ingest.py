@@ -4,22 +4,162 @@ import os
 import requests
 import json
 import argparse
+import threading
+import queue
+import numpy as np
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from itertools import islice, compress, groupby
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
+from geo import sequence_numbers, shard_key
+from columnar import ColumnarPartition, is_columnar, MAGIC
+from members import fromisoformat, datetime_score, MEMBER_VERSION, member_encodings, _member_header, text_member, binary_member, decode_member, version_key, counts_key, shards_key
+from reader import read_chunks, partition_suffixes, decompress_chunks, partition_name, partition_data, json_rows, without_removed, removed_mask
+from time import time
 
-# support for python 3.6
-def fromisoformat(value):
-   if hasattr(datetime,'fromisoformat'):
-      return datetime.fromisoformat(value)
-   else:
-      if value.find('.')<0:
-         return datetime.strptime(value,'%Y-%m-%dT%H:%M:%S')
+def expand_delta(rows):
+   """
+   Iterates the rows of a delta-encoded partition (collect.py --delta) as the
+   full view of every poll: each sensor's last recorded reading with the
+   poll's timestamp. The 'delta' field is removed, the state is reset at
+   each keyframe, sensors that are no longer reported are removed, and a
+   poll without changes repeats the state. Other partitions are passed
+   through unchanged.
+   """
+   rows = iter(rows)
+   header = next(rows,None)
+   if header is None:
+      return
+   if header[-1]!='delta':
+      yield header
+      yield from rows
+      return
+   yield header[:-1]
+   id_position = header.index('ID') if 'ID' in header else 1
+   # sensor id -> the reading without the timestamp and delta marker
+   state = {}
+   for timestamp, poll in groupby(rows,key=lambda row: row[0]):
+      for position, row in enumerate(poll):
+         if position==0 and row[-1]=='K':
+            state = {}
+         if row[-1]=='R':
+            state.pop(row[id_position],None)
+         elif row[-1]!='N':
+            state[row[id_position]] = row[1:-1]
+      for values in state.values():
+         yield [timestamp] + values
+
+class IngestMetrics:
+   """
+   Counters and timings for the ingest of a source. The timings are
+   accumulated per stage: request (waiting for a response), fetch (reading
+   bytes), parse (decoding rows), encode (filtering and encoding members),
+   and execute (Redis pipelines).
+
+   The totals of a run add the metrics of every source (see add) where the
+   sources may be ingested concurrently, so the summed time of the sources is
+   kept separately and the elapsed time is the wall-clock time of the run.
+   """
+
+   reasons = ['location','age','indoor','empty','open']
+   stages = ['request','fetch','parse','encode','execute']
+
+   def __init__(self,source=None):
+      self.source = source
+      self.sources = 0
+      self.rows_read = 0
+      self.rows_written = 0
+      self.bytes = 0
+      self.rejected = {reason : 0 for reason in IngestMetrics.reasons}
+      # inclusive times of the nested iterators (see summary)
+      self.timings = {stage : 0.0 for stage in IngestMetrics.stages}
+      self.elapsed = 0.0
+      # the summed elapsed time of the sources added
+      self.sources_elapsed = 0.0
+
+   def timed(self,iterable,stage,count_bytes=False):
+      iterator = iter(iterable)
+      while True:
+         start = time()
+         try:
+            value = next(iterator)
+         except StopIteration:
+            self.timings[stage] += time() - start
+            return
+         self.timings[stage] += time() - start
+         if count_bytes:
+            self.bytes += len(value)
+         yield value
+
+   def add(self,other):
+      self.sources += other.sources
+      self.rows_read += other.rows_read
+      self.rows_written += other.rows_written
+      self.bytes += other.bytes
+      for reason in IngestMetrics.reasons:
+         self.rejected[reason] += other.rejected[reason]
+      for stage in IngestMetrics.stages:
+         self.timings[stage] += other.timings[stage]
+      self.sources_elapsed += other.elapsed
+
+   def summary(self):
+      # the stages are nested iterators, so subtract the inner stage
+      fetch = self.timings['fetch']
+      parse = max(self.timings['parse'] - fetch,0.0) if self.timings['parse']>0 else 0.0
+      encode = max(self.timings['encode'] - self.timings['parse'],0.0) if self.timings['encode']>0 else 0.0
+      summary = {
+         'rows_read' : self.rows_read,
+         'rows_written' : self.rows_written,
+         'rejected' : dict(self.rejected),
+         'bytes' : self.bytes,
+         'seconds' : {'request' : self.timings['request'], 'fetch' : fetch, 'parse' : parse, 'encode' : encode, 'execute' : self.timings['execute'], 'total' : self.elapsed},
+         'rows_per_second' : self.rows_read / self.elapsed if self.elapsed > 0 else 0.0
+      }
+      if self.source is not None:
+         summary['source'] = self.source if type(self.source)==str else '-'
       else:
-         return datetime.strptime(value,'%Y-%m-%dT%H:%M:%S.%f')
+         summary['sources'] = self.sources
+         summary['seconds']['sources'] = self.sources_elapsed
+      return summary
+
+   def json(self):
+      return json.dumps(self.summary())
+
+   def prometheus(self):
+      summary = self.summary()
+      lines = []
+      def metric(name,kind,help,values):
+         lines.append('# HELP aqi_ingest_{name} {help}'.format(name=name,help=help))
+         lines.append('# TYPE aqi_ingest_{name} {kind}'.format(name=name,kind=kind))
+         for labels, value in values:
+            lines.append('aqi_ingest_{name}{labels} {value}'.format(name=name,labels=labels,value=value))
+      metric('sources_total','counter','Sources ingested',[('',self.sources)])
+      metric('rows_read_total','counter','Rows read from the sources',[('',summary['rows_read'])])
+      metric('rows_written_total','counter','Members written to Redis',[('',summary['rows_written'])])
+      metric('rows_rejected_total','counter','Rows rejected by reason',[('{{reason="{}"}}'.format(reason),count) for reason, count in summary['rejected'].items()])
+      metric('bytes_total','counter','Bytes read from the sources',[('',summary['bytes'])])
+      metric('seconds_total','counter','Time spent by stage',[('{{stage="{}"}}'.format(stage),value) for stage, value in summary['seconds'].items() if stage!='sources'])
+      if 'sources' in summary['seconds']:
+         metric('sources_seconds_total','counter','Time spent by the sources (summed over concurrent workers)',[('',summary['seconds']['sources'])])
+      metric('rows_per_second','gauge','Rows read per second',[('',summary['rows_per_second'])])
+      return '\n'.join(lines) + '\n'
 
-def datetime_score(value):
-   return value.year*10**8 + value.month*10**6 + value.day*10**4 + value.hour*60 + value.minute
+   def write_textfile(self,path):
+      # write atomically for the node exporter textfile collector
+      tmp = path + '.tmp'
+      with open(tmp,'w') as output:
+         output.write(self.prometheus())
+      os.replace(tmp,path)
 
-def ingest(client, data, precision=None, indices=None,box=None, partition=30,prefix='AQI30-',verbose=False):
+def readings(data, indices=None, partition=30, prefix='AQI30-', metrics=None):
+   """
+   Iterates the valid readings for the rows of a partition file as
+   (key, partition_start, lon, lat, id, offset, pm) tuples. Rows without a
+   location, older than 30 minutes, from indoor sensors, or without
+   measurements are skipped.
+   """
    # pm_0 : now
    # pm_1 : 10M
    # pm_2 : 30M
@@ -30,34 +170,33 @@ def ingest(client, data, precision=None, indices=None,box=None, partition=30,pre
    # ['timestamp', 'ID', 'age', 'pm_0', 'pm_1', 'pm_2', 'pm_3', 'pm_4', 'pm_5', 'pm_6', 'conf', 'Type', 'Label', 'Lat', 'Lon', 'isOwner', 'Flags', 'CH']
    # print(data[0])
    duration = 'PT' + str(partition) + 'M'
-   partiton_set = prefix + duration
-   last_partition_no = -1
-   last_hour = -1
-   count = 0
-   batch_size = 1000
-   pipe = client.pipeline(transaction=False)
-   for row in data[1:]:
+   rows = without_removed(data)
+   # skip the header row
+   next(rows,None)
+   for row in rows:
+      if metrics is not None:
+         metrics.rows_read += 1
       # We must have a lat/lon
       if row[13] is None or row[14] is None:
+         if metrics is not None:
+            metrics.rejected['location'] += 1
          continue
       # The age should be less than 30 minutes and the sensor must be outdoor (0)
       if row[2]>30 or row[11]!=0:
+         if metrics is not None:
+            metrics.rejected['age' if row[2]>30 else 'indoor'] += 1
          continue
 
       pm = [float(row[3 + index]) if row[3 + index] is not None else 0.0 for index in range(7)]
       if sum(pm) == 0:
          # no measurements - bad row
+         if metrics is not None:
+            metrics.rejected['empty'] += 1
          continue
 
       if indices is not None:
          pm = [pm[i] for i in indices]
 
-      if precision is not None:
-         if precision==0:
-            pm = map(round,pm)
-         else:
-            pm = map(lambda v : round(v,precision),pm)
-
       timestamp = fromisoformat(row[0])
       lat, lon = float(row[13]), float(row[14])
 
@@ -65,31 +204,652 @@ def ingest(client, data, precision=None, indices=None,box=None, partition=30,pre
       partition_start = datetime(timestamp.year,timestamp.month,timestamp.day,timestamp.hour,partition_no * partition,tzinfo=timestamp.tzinfo)
       partition_duration = partition_start.isoformat() + duration
       offset = timestamp.minute % partition
-      key = prefix + partition_duration
 
       # prefix + partition start dateTime + duration (e.g., AQI30-2020-08-25T16:00:00PT30M)
-      pipe.geoadd(key,lon,lat,str(row[1]) + '@' + str(offset) + ',' + ','.join(map(str,pm)))
-      if last_hour!=partition_start.hour or last_partition_no != partition_no:
+      key = prefix + partition_duration
+
+      yield key, partition_start, lon, lat, row[1], offset, pm
+
+def round_values(pm, precision=None):
+   if precision is None:
+      return pm
+   if precision==0:
+      return map(round,pm)
+   return map(lambda v : round(v,precision),pm)
+
+def encode_rows(data, precision=None, indices=None, partition=30, prefix='AQI30-', encoding='text', metrics=None):
+   """
+   Iterates the encoded readings for the rows of a partition file as
+   (key, partition_start, lon, lat, member) tuples. The binary encoding has a
+   fixed precision and ignores the precision argument.
+   """
+   for key, partition_start, lon, lat, id, offset, pm in readings(data,indices=indices,partition=partition,prefix=prefix,metrics=metrics):
+      if encoding=='binary':
+         yield key, partition_start, lon, lat, binary_member(id,offset,pm)
+      else:
+         yield key, partition_start, lon, lat, text_member(id,offset,round_values(pm,precision))
+
+def encode_rows_vectorized(data, precision=None, indices=None, partition=30, prefix='AQI30-', encoding='text', metrics=None, chunk_size=10000):
+   """
+   A batch version of encode_rows() that converts chunks of rows into NumPy
+   columns and applies the filters, index selection, and rounding as array
+   operations. The members are identical to those produced by encode_rows().
+   """
+   rows = without_removed(data)
+   # skip the header row
+   next(rows,None)
+
+   # timestamp -> (key, partition_start, offset, '@offset,') for each distinct poll time
+   partitions = {}
+
+   while True:
+      chunk = list(islice(rows,chunk_size))
+      if len(chunk)==0:
+         return
+
+      columns = list(zip(*chunk))
+      yield from encode_columns(columns[1],columns[0],columns[2],columns[11],columns[13],columns[14],columns[3:10],partitions,precision=precision,indices=indices,partition=partition,prefix=prefix,encoding=encoding,metrics=metrics)
+
+def encode_columnar(data, precision=None, indices=None, partition=30, prefix='AQI30-', encoding='text', metrics=None, chunk_size=10000):
+   """
+   A version of encode_rows_vectorized() for a columnar partition that reads
+   the columns directly from the partition in chunks. The fields are taken
+   by their position as for the JSON rows.
+   """
+   fields = data.fields
+   partitions = {}
+   for start in range(0,len(data),chunk_size):
+      end = min(start + chunk_size,len(data))
+      readings = removed_mask(data,start,end)
+      def column(position):
+         values = data.column(fields[position],start,end)
+         return values if readings is None else values[readings]
+      yield from encode_columns(column(1).tolist(),column(0).tolist(),column(2),column(11),column(13),column(14),[column(position) for position in range(3,10)],partitions,precision=precision,indices=indices,partition=partition,prefix=prefix,encoding=encoding,metrics=metrics)
+
+def encode_columns(ids, timestamps, age, kind, lat, lon, pm, partitions, precision=None, indices=None, partition=30, prefix='AQI30-', encoding='text', metrics=None):
+   """
+   Filters and encodes a batch of readings given as columns (the seven PM
+   columns are in pm). The partitions dictionary caches the partition of
+   each distinct timestamp across batches.
+   """
+   duration = 'PT' + str(partition) + 'M'
+
+   # None values become NaN
+   age = np.array(age,dtype=float)
+   kind = np.array(kind,dtype=float)
+   lat = np.array(lat,dtype=float)
+   lon = np.array(lon,dtype=float)
+   pm = np.array(pm,dtype=float).T
+   pm[np.isnan(pm)] = 0.0
+
+   # summed in column order as sum() would
+   total = pm[:,0]
+   for index in range(1,7):
+      total = total + pm[:,index]
+
+   # We must have a lat/lon, the age should be less than 30 minutes, the
+   # sensor must be outdoor (0), and there must be measurements
+   mask = ~np.isnan(lat) & ~np.isnan(lon) & ~(age>30) & (kind==0) & (total!=0)
+
+   if metrics is not None:
+      located = ~np.isnan(lat) & ~np.isnan(lon)
+      metrics.rows_read += len(age)
+      metrics.rejected['location'] += int(np.count_nonzero(~located))
+      metrics.rejected['age'] += int(np.count_nonzero(located & (age>30)))
+      metrics.rejected['indoor'] += int(np.count_nonzero(located & ~(age>30) & (kind!=0)))
+      metrics.rejected['empty'] += int(np.count_nonzero(located & ~(age>30) & (kind==0) & (total==0)))
+
+   pm = pm[mask]
+   if indices is not None:
+      pm = pm[:,indices]
+
+   if encoding=='binary':
+      # np.rint rounds half to even like round()
+      values = np.clip(np.rint(pm*10),0,65535).astype('<u2')
+   elif precision is None:
+      values = pm.tolist()
+   elif precision==0:
+      # np.rint rounds half to even like round()
+      values = np.rint(pm).astype(np.int64).tolist()
+   else:
+      # np.round does not always match round() for ties after scaling
+      values = [[round(v,precision) for v in row] for row in pm.tolist()]
+
+   for id, timestamp, lat_value, lon_value, pm_values in zip(compress(ids,mask),compress(timestamps,mask),lat[mask].tolist(),lon[mask].tolist(),values):
+      info = partitions.get(timestamp)
+      if info is None:
+         t = fromisoformat(timestamp)
+         partition_no = t.minute // partition
+         partition_start = datetime(t.year,t.month,t.day,t.hour,partition_no * partition,tzinfo=t.tzinfo)
+         offset = t.minute % partition
+         info = partitions[timestamp] = (prefix + partition_start.isoformat() + duration, partition_start, offset, '@' + str(offset) + ',')
+      key, partition_start, offset, text_offset = info
+      if encoding=='binary':
+         yield key, partition_start, lon_value, lat_value, _member_header.pack(MEMBER_VERSION,int(id),offset) + pm_values.tobytes()
+      else:
+         yield key, partition_start, lon_value, lat_value, str(id) + text_offset + ','.join(map(str,pm_values))
+
+aggregate_methods = ['latest','mean','max']
+
+def accumulate(sensors, sensor, partition_start, lon, lat, offset, pm, method='latest'):
+   """
+   Adds a reading to the per-sensor aggregates where sensor is the
+   (key, id) tuple. The location and offset are those of the latest reading.
+   """
+   current = sensors.get(sensor)
+   if current is None:
+      sensors[sensor] = [partition_start, lon, lat, offset, pm, 1]
+      return
+   latest = offset >= current[3]
+   if latest:
+      current[1:4] = [lon, lat, offset]
+   if method=='latest':
+      if latest:
+         current[4] = pm
+   elif method=='mean':
+      current[4] = [a + b for a, b in zip(current[4],pm)]
+   else:
+      current[4] = [max(a,b) for a, b in zip(current[4],pm)]
+   current[5] += 1
+
+def aggregated_members(sensors, method='latest', precision=None, encoding='text'):
+   """
+   Iterates the (key, partition_start, lon, lat, member) tuples for the
+   per-sensor aggregates.
+   """
+   for (key, id), (partition_start, lon, lat, offset, pm, count) in sensors.items():
+      if method=='mean':
+         pm = [value / count for value in pm]
+      if encoding=='binary':
+         yield key, partition_start, lon, lat, binary_member(id,offset,pm)
+      else:
+         yield key, partition_start, lon, lat, text_member(id,offset,list(round_values(pm,precision)))
+
+def aggregated_counts(sensors, counts=None):
+   """
+   Returns the number of readings aggregated for each sensor by partition
+   key (i.e., key -> {id : count}), adding them to counts when given.
+   """
+   counts = counts if counts is not None else {}
+   for (key, id), aggregate in sensors.items():
+      counts.setdefault(key,{})[id] = aggregate[5]
+   return counts
+
+def write_counts(pipe, counts):
+   for key, sensors in counts.items():
+      pipe.hset(counts_key(key),mapping=sensors)
+
+def aggregate_rows(data, method='latest', precision=None, indices=None, partition=30, prefix='AQI30-', encoding='text', metrics=None, counts=None):
+   """
+   Collapses the readings of each sensor to a single member per partition
+   key and iterates them as (key, partition_start, lon, lat, member) tuples.
+   The member uses the same encoding as encode_rows() with the offset of the
+   latest reading (e.g., B123@29,145.5,150,148.9).
+
+   Only the readings of closed partitions are aggregated as a later ingest
+   of an open partition would add a second member for each sensor.
+
+   Arguments:
+   method - latest (the last reading), mean, or max of the readings in the partition
+   counts - a dictionary that receives the number of readings aggregated (see aggregated_counts)
+   """
+   if method not in aggregate_methods:
+      raise ValueError('Unknown aggregation method: '+str(method))
+
+   now = datetime.utcnow()
+
+   # (key, id) -> [partition_start, lon, lat, offset, pm, count]
+   sensors = {}
+   for key, partition_start, lon, lat, id, offset, pm in readings(data,indices=indices,partition=partition,prefix=prefix,metrics=metrics):
+      if partition_start.replace(tzinfo=None) + timedelta(minutes=partition) > now:
+         if metrics is not None:
+            metrics.rejected['open'] += 1
+         continue
+      accumulate(sensors,(key,id),partition_start,lon,lat,offset,pm,method=method)
+
+   if counts is not None:
+      aggregated_counts(sensors,counts)
+
+   return aggregated_members(sensors,method=method,precision=precision,encoding=encoding)
+
+def encode_members(data, precision=None, indices=None, partition=30, prefix='AQI30-', vectorized=False, aggregate=None, encoding='text', metrics=None, counts=None):
+   """
+   Iterates the (key, partition_start, lon, lat, member) tuples for the rows
+   using the row, vectorized, or aggregated encoding. A columnar partition is
+   always encoded by columns unless it is aggregated.
+   """
+   if encoding not in member_encodings:
+      raise ValueError('Unknown member encoding: '+str(encoding))
+   if isinstance(data,ColumnarPartition):
+      if aggregate is None:
+         return encode_columnar(data,precision=precision,indices=indices,partition=partition,prefix=prefix,encoding=encoding,metrics=metrics)
+      data = data.rows()
+   if aggregate is not None:
+      return aggregate_rows(data,method=aggregate,precision=precision,indices=indices,partition=partition,prefix=prefix,encoding=encoding,metrics=metrics,counts=counts)
+   encode = encode_rows_vectorized if vectorized else encode_rows
+   return encode(data,precision=precision,indices=indices,partition=partition,prefix=prefix,encoding=encoding,metrics=metrics)
+
+def metered_members(data, metrics, **kwargs):
+   """
+   Returns encode_members() for the rows, timing the parse and encode stages
+   when metrics are collected.
+   """
+   if metrics is None:
+      return encode_members(data,**kwargs)
+   if isinstance(data,ColumnarPartition):
+      # there is nothing to parse
+      return metrics.timed(encode_members(data,metrics=metrics,**kwargs),'encode')
+   return metrics.timed(encode_members(metrics.timed(data,'parse'),metrics=metrics,**kwargs),'encode')
+
+def targeted_members(members, shard_size=None, chunk_size=10000):
+   """
+   Iterates the (target, key, partition_start, lon, lat, member) of the
+   members where the target is the partition key or, when shard_size is
+   specified, the shard key of the location (see geo.shard_key). The
+   sequence numbers are computed for chunks of members at a time.
+   """
+   if shard_size is None:
+      for key, partition_start, lon, lat, member in members:
+         yield key, key, partition_start, lon, lat, member
+      return
+   members = iter(members)
+   while True:
+      chunk = list(islice(members,chunk_size))
+      if len(chunk)==0:
+         return
+      numbers = sequence_numbers(shard_size,[item[3] for item in chunk],[item[2] for item in chunk]).tolist()
+      for (key, partition_start, lon, lat, member), number in zip(chunk,numbers):
+         yield shard_key(key,shard_size,number), key, partition_start, lon, lat, member
+
+def report_rate(count,start):
+   elapsed = time() - start
+   rate = count / elapsed if elapsed > 0 else 0.0
+   print('{count} rows in {elapsed:.3f}s ({rate:.1f} rows/s)'.format(count=count,elapsed=elapsed,rate=rate),flush=True)
+
+def ingest(client, data, precision=None, indices=None,box=None, partition=30,prefix='AQI30-',group_size=None,vectorized=False,aggregate=None,encoding='text',shard_size=None,metrics=None,verbose=False):
+   if group_size is not None and group_size>0:
+      return ingest_grouped(client,data,precision=precision,indices=indices,box=box,partition=partition,prefix=prefix,group_size=group_size,vectorized=vectorized,aggregate=aggregate,encoding=encoding,shard_size=shard_size,metrics=metrics,verbose=verbose)
+   duration = 'PT' + str(partition) + 'M'
+   partiton_set = prefix + duration
+   versions = version_key(prefix)
+   last_key = None
+   pending = set()
+   shards = set()
+   count = 0
+   batch_size = 1000
+   start = time()
+   pipe = client.pipeline(transaction=False)
+
+   def execute():
+      # the versions are incremented after the members are added
+      for key in pending:
+         pipe.hincrby(versions,key,1)
+      pending.clear()
+      execute_start = time()
+      pipe.execute()
+      if metrics is not None:
+         metrics.timings['execute'] += time() - execute_start
+
+   counts = {} if aggregate is not None else None
+   members = metered_members(data,metrics,precision=precision,indices=indices,partition=partition,prefix=prefix,vectorized=vectorized,aggregate=aggregate,encoding=encoding,counts=counts)
+   for target, key, partition_start, lon, lat, member in targeted_members(members,shard_size=shard_size,chunk_size=batch_size):
+      # GEOADD key lon lat member (geoadd() changed its signature in redis-py 4)
+      pipe.execute_command('GEOADD',target,lon,lat,member)
+      pending.add(key)
+      if target != key and target not in shards:
+         # register the shard so that it can be found without scanning the keys
+         shards.add(target)
+         pipe.sadd(shards_key(key),target)
+      if last_key != key:
          # prefix + duration (e.g., AQI30-PT30M)
          score = datetime_score(partition_start)
          pipe.zadd(partiton_set,{key : score})
-      last_partition_no = partition_no
-      last_hour = partition_start.hour
+      last_key = key
       count += 1
       if count % batch_size == 0:
-         pipe.execute()
+         execute()
       if verbose:
          print(str(count),end='')
          print('\r',end='')
-   pipe.execute()
+   if counts:
+      write_counts(pipe,counts)
+   execute()
+   if metrics is not None:
+      metrics.rows_written += count
+      metrics.elapsed += time() - start
    if verbose:
       print()
+      report_rate(count,start)
+   return count
 
+def ingest_grouped(client, data, precision=None, indices=None,box=None, partition=30,prefix='AQI30-',group_size=500,batch_size=20,vectorized=False,aggregate=None,encoding='text',shard_size=None,metrics=None,verbose=False):
+   """
+   Ingests the rows by gathering the members for each partition key and
+   sending multi-member GEOADD commands of group_size members. The pipeline
+   is executed every batch_size commands and each partition key is
+   registered in the partition set once per executed batch.
 
-def ingest_urls(source,client,precision=None,indices=None,box=None, partition=30,prefix='AQI30-',verbose=False,confirm=False):
+   When shard_size is specified, the members are split into per-cell keys
+   by the sequence number of their location (see geo.shard_key), the
+   partition key is only registered in the partition set, and the shard keys
+   are registered in the shard set of the partition (see members.shards_key).
+   """
+   duration = 'PT' + str(partition) + 'M'
+   partiton_set = prefix + duration
+   versions = version_key(prefix)
+   groups = {}
+   scores = {}
+   pending = set()
+   commands = 0
+   count = 0
+   start = time()
+   pipe = client.pipeline(transaction=False)
+
+   def execute():
+      # prefix + duration (e.g., AQI30-PT30M)
+      pipe.zadd(partiton_set,{key : scores[key] for key in pending})
+      # the versions are incremented after the members are added
+      for key in pending:
+         pipe.hincrby(versions,key,1)
+      execute_start = time()
+      pipe.execute()
+      if metrics is not None:
+         metrics.timings['execute'] += time() - execute_start
+      pending.clear()
+
+   counts = {} if aggregate is not None else None
+   members = metered_members(data,metrics,precision=precision,indices=indices,partition=partition,prefix=prefix,vectorized=vectorized,aggregate=aggregate,encoding=encoding,counts=counts)
+   for target, key, partition_start, lon, lat, member in targeted_members(members,shard_size=shard_size):
+      if key not in scores:
+         scores[key] = datetime_score(partition_start)
+      pending.add(key)
+      group = groups.get(target)
+      if group is None:
+         group = groups[target] = []
+         if target != key:
+            pipe.sadd(shards_key(key),target)
+      group.extend((lon,lat,member))
+      count += 1
+      if len(group) >= group_size*3:
+         # GEOADD key lon lat member [lon lat member ...]
+         pipe.execute_command('GEOADD',target,*group)
+         group.clear()
+         commands += 1
+         if commands % batch_size == 0:
+            execute()
+            if verbose:
+               print(str(count),end='')
+               print('\r',end='')
+
+   for key, group in groups.items():
+      if len(group)>0:
+         pipe.execute_command('GEOADD',key,*group)
+   if counts:
+      write_counts(pipe,counts)
+   if len(pending)>0:
+      execute()
+   if metrics is not None:
+      metrics.rows_written += count
+      metrics.elapsed += time() - start
+   if verbose:
+      print()
+      report_rate(count,start)
+   return count
+
+class SourceError(Exception):
+   def __init__(self,source,status,text):
+      super().__init__('Error getting {}, status={}'.format(source,status))
+      self.source = source
+      self.status = status
+      self.text = text
+
+def create_session(pool_size=10):
+   session = requests.Session()
+   adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size)
+   session.mount('http://',adapter)
+   session.mount('https://',adapter)
+   return session
+
+def create_s3_client(endpoint=None,key=None,secret=None,pool_size=10):
+   """
+   Creates an S3 client with a connection pool large enough to be shared by
+   pool_size worker threads.
+   """
+   kwargs = {}
+   if endpoint is not None:
+      kwargs['endpoint_url'] = endpoint
+   if key is not None:
+      kwargs['aws_access_key_id'] = key
+   if secret is not None:
+      kwargs['aws_secret_access_key'] = secret
+   return boto3.client(
+      's3',
+      config=Config(max_pool_connections=pool_size),
+      **kwargs
+   )
+
+def parse_s3_url(url):
+   """
+   Splits an s3://bucket/key url into the bucket and key (or key prefix).
+   """
+   if not url.startswith('s3://'):
+      raise ValueError('Not an S3 url: '+url)
+   bucket, _, key = url[5:].partition('/')
+   return bucket, key
+
+def s3_partitions(s3,bucket,prefix='data-',start=None,end=None):
+   """
+   Iterates the s3:// urls of the partition objects (prefix + ISO 8601
+   datetime + a partition suffix) in a bucket. When a start is given, only the days
+   from start to end are listed and the partitions that start outside of
+   [start,end] are skipped.
+   """
+   if start is None:
+      prefixes = [prefix]
+   else:
+      end = start if end is None else end
+      day = start.date()
+      prefixes = []
+      while day <= end.date():
+         prefixes.append(prefix + day.isoformat())
+         day += timedelta(days=1)
+   paginator = s3.get_paginator('list_objects_v2')
+   for list_prefix in prefixes:
+      for page in paginator.paginate(Bucket=bucket,Prefix=list_prefix):
+         for obj in page.get('Contents',[]):
+            key = obj['Key']
+            name = partition_name(key)
+            if name is None:
+               continue
+            try:
+               partition_start = fromisoformat(name[len(prefix):])
+            except ValueError:
+               continue
+            if start is not None and (partition_start < start or partition_start > end):
+               continue
+            yield 's3://' + bucket + '/' + key
+
+def ingest_source(client,source,session=None,s3=None,ignore_not_found=False,confirm=False,report=None,expand=False,**kwargs):
+   """
+   Ingests a single data source and returns the number of rows ingested.
+
+   Arguments:
+   client - the Redis client instance
+   source - a local file name, a url, or a file-like object
+   session - the requests session to use for urls (defaults to None)
+   s3 - the S3 client to use for s3:// urls (see create_s3_client)
+   ignore_not_found - skip urls that are not found instead of raising a SourceError
+   confirm - output the source being ingested
+   report - a function called with the IngestMetrics of the source (defaults to None)
+   expand - rebuild the full view of every poll of a delta-encoded partition (see expand_delta)
+   """
+   if confirm:
+      print(source,flush=True)
+   metrics = IngestMetrics(source) if report is not None else None
+
+   def expanded(data):
+      if not expand:
+         return data
+      return expand_delta(data.rows() if isinstance(data,ColumnarPartition) else data)
+
+   def rows(chunks):
+      return expanded(partition_data(decompress_chunks(chunks if metrics is None else metrics.timed(chunks,'fetch',count_bytes=True))))
+
+   def done(count):
+      if metrics is not None:
+         metrics.sources = 1
+         report(metrics)
+      return count
+
+   if type(source)!=str:
+      # read the bytes of text streams (e.g., stdin) so compressed content is detected
+      return done(ingest(client,rows(read_chunks(getattr(source,'buffer',source))),metrics=metrics,**kwargs))
+   if os.path.isfile(source):
+      with open(source,'rb') as input:
+         if is_columnar(input.read(len(MAGIC))):
+            # uncompressed columnar partitions are memory mapped
+            if metrics is not None:
+               metrics.bytes += os.path.getsize(source)
+            return done(ingest(client,expanded(ColumnarPartition.open(source)),metrics=metrics,**kwargs))
+         input.seek(0)
+         return done(ingest(client,rows(read_chunks(input)),metrics=metrics,**kwargs))
+   if source.startswith('s3://'):
+      bucket, key = parse_s3_url(source)
+      if s3 is None:
+         raise ValueError('An S3 client is required for '+source)
+      request_start = time()
+      try:
+         obj = s3.get_object(Bucket=bucket,Key=key)
+      except ClientError as ex:
+         status = ex.response.get('ResponseMetadata',{}).get('HTTPStatusCode')
+         if ignore_not_found and status==404:
+            print('{} not found'.format(source),file=sys.stderr)
+            return 0
+         raise SourceError(source,status,str(ex))
+      if metrics is not None:
+         metrics.timings['request'] += time() - request_start
+         metrics.elapsed += time() - request_start
+      body = obj['Body']
+      try:
+         return done(ingest(client,rows(body.iter_chunks(chunk_size=65536)),metrics=metrics,**kwargs))
+      finally:
+         body.close()
+   http = session if session is not None else requests
+   request_start = time()
+   with http.get(source,stream=True) as resp:
+      if metrics is not None:
+         metrics.timings['request'] += time() - request_start
+         metrics.elapsed += time() - request_start
+      if resp.status_code==200:
+         return done(ingest(client,rows(resp.iter_content(chunk_size=65536)),metrics=metrics,**kwargs))
+      if ignore_not_found and resp.status_code==404:
+         print('{} not found'.format(source),file=sys.stderr)
+         return 0
+      raise SourceError(source,resp.status_code,resp.text)
+
+def ingest_sources(client,sources,workers=1,s3=None,ignore_not_found=False,confirm=False,**kwargs):
+   """
+   Ingests a list of data sources and returns the number of rows ingested. When
+   workers is greater than one, the sources are downloaded, parsed, and
+   written to Redis concurrently by a pool of threads, each with its own
+   pooled HTTP session. The S3 client (for s3:// sources) is thread-safe and
+   shared by the workers. The first SourceError cancels the remaining sources.
+   """
+   if workers is None or workers<=1:
+      total = 0
+      for source in sources:
+         total += ingest_source(client,source,s3=s3,ignore_not_found=ignore_not_found,confirm=confirm,**kwargs)
+      return total
+
+   local = threading.local()
+   def run(source):
+      session = getattr(local,'session',None)
+      if session is None:
+         session = local.session = create_session()
+      return ingest_source(client,source,session=session,s3=s3,ignore_not_found=ignore_not_found,confirm=confirm,**kwargs)
+
+   total = 0
+   with ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = [executor.submit(run,source) for source in sources]
+      try:
+         for future in futures:
+            total += future.result()
+      except:
+         for future in futures:
+            future.cancel()
+         raise
+   return total
+
+def stream_records(lines):
+   """
+   Iterates the JSON records of a record-separated stream (RFC 7464) such as
+   the output of collect.py. Each record is on its own line and optionally
+   prefixed by the record separator (0x1E). Invalid records are reported
+   and skipped.
+   """
+   for line in lines:
+      if isinstance(line,bytes):
+         line = line.decode('utf-8')
+      line = line.strip('\u001e \t\r\n')
+      if len(line)==0:
+         continue
+      try:
+         yield json.loads(line)
+      except json.JSONDecodeError as ex:
+         print('Invalid record: {}'.format(str(ex)),file=sys.stderr,flush=True)
+
+def ingest_stream(client,source,queue_size=4,confirm=False,report=None,**kwargs):
+   """
+   Ingests an unbounded record-separated stream of partitions or polls (e.g.,
+   from collect.py) as each record arrives. A reader thread parses the records
+   into a bounded queue so that a slow Redis applies backpressure to the
+   producer. Returns the number of rows ingested once the stream ends.
+
+   Arguments:
+   client - the Redis client instance
+   source - an iterable of lines (e.g., sys.stdin or resp.iter_lines())
+   queue_size - the maximum number of parsed records waiting to be ingested
+   report - a function called with the IngestMetrics of each record (defaults to None)
+   """
+   records = queue.Queue(maxsize=queue_size)
+   failure = []
+
+   def read():
+      try:
+         for record in stream_records(source):
+            records.put(record)
+      except Exception as ex:
+         failure.append(ex)
+      finally:
+         records.put(None)
+
+   reader = threading.Thread(target=read,daemon=True)
+   reader.start()
+
+   total = 0
+   while True:
+      record = records.get()
+      if record is None:
+         break
+      data = record.get('data') if isinstance(record,dict) else record
+      if data is None:
+         continue
+      if confirm:
+         print('{} : {} rows'.format(record.get('start','') if isinstance(record,dict) else '',max(len(data)-1,0)),flush=True)
+      metrics = IngestMetrics(record.get('start') if isinstance(record,dict) else None) if report is not None else None
+      total += ingest(client,data,metrics=metrics,**kwargs)
+      if metrics is not None:
+         metrics.sources = 1
+         report(metrics)
+   reader.join()
+   if len(failure)>0:
+      raise failure[0]
+   return total
+
+def ingest_urls(source,client,workers=1,s3=None,ignore_not_found=False,confirm=False,**kwargs):
    if type(source)==str:
       def from_string():
-         for url in str.split('\n'):
+         for url in source.split('\n'):
             if len(url)>0:
                yield url.strip()
       urls = from_string()
@@ -101,16 +861,7 @@ def ingest_urls(source,client,precision=None,indices=None,box=None, partition=30
                yield url
       urls = from_file()
 
-   for url in urls:
-      if verbose or confirm:
-         print(url)
-      resp = requests.get(url)
-      if resp.status_code==200:
-         ingest(client,resp.json(),precision=precision,indices=indices,box=box,partition=partition,prefix=prefix,verbose=verbose)
-      else:
-         print('Error getting {}, status={}'.format(spec,resp.status_code))
-         print(resp.text)
-         sys.exit(1)
+   return ingest_sources(client,urls,workers=workers,s3=s3,ignore_not_found=ignore_not_found,confirm=confirm or kwargs.get('verbose',False),**kwargs)
 
 def date_range(spec,partition=30):
    parts = spec.split(',')
@@ -134,6 +885,20 @@ def date_range(spec,partition=30):
       yield current_dt
       current_dt += timedelta(minutes=partition)
 
+def date_bounds(spec):
+   """
+   Returns the (start, end) datetimes of a date range specification (see
+   date_range) where the end is the start for a single datetime.
+   """
+   parts = spec.split(',')
+   if len(parts)<1 or len(parts)>3:
+      raise ValueError(spec+' is not a valid date rate')
+   start = fromisoformat(parts[0])
+   end = fromisoformat(parts[1]) if len(parts)>1 else start
+   if start > end:
+      raise ValueError('End date is before start.')
+   return start, end
+
 
 if __name__ == '__main__':
 
@@ -145,12 +910,26 @@ if __name__ == '__main__':
    argparser.add_argument('--confirm',help='Confirm partitions',action='store_true',default=False)
    argparser.add_argument('--index',help='The PM measurement index (list of integers)')
    argparser.add_argument('--precision',help='Round the measurements to the precision',type=int)
-   argparser.add_argument('--key-prefix',help='The key prefix.',default='AQI30-')
-   argparser.add_argument('--bucket-url',help='The bucket url prefix')
+   argparser.add_argument('--key-prefix',help='The key prefix (defaults to AQI30- or AQI30B- for binary members).')
+   argparser.add_argument('--bucket-url',help='The bucket url prefix (s3://bucket/prefix for --type s3)')
+   argparser.add_argument('--suffix',help='The partition file suffix for --type now and at',choices=partition_suffixes,default='.json')
+   argparser.add_argument('--s3-endpoint',help='The S3 endpoint url')
+   argparser.add_argument('--s3-key',help='The S3 Access Key')
+   argparser.add_argument('--s3-secret',help='The S3 Secret')
    argparser.add_argument('--partition',help='The time partition (in minutes, must be a divisor of 60)',default=30,type=int)
+   argparser.add_argument('--vectorized',help='Filter and encode rows in NumPy batches',action='store_true',default=False)
+   argparser.add_argument('--aggregate',help='Collapse each sensor to one member per partition',choices=aggregate_methods)
+   argparser.add_argument('--encoding',help='The member encoding',choices=member_encodings,default='text')
+   argparser.add_argument('--shard-size',help='Split partitions into per-cell keys of quadrangles of this size (degrees)',type=float)
+   argparser.add_argument('--cluster',help='Connect to a Redis Cluster',action='store_true',default=False)
+   argparser.add_argument('--group-size',help='Group members by partition key into GEOADD commands of this size',type=int)
    argparser.add_argument('--bounding-box',help='The bounding box (nwlat,nwlon,selat,selon)')
-   argparser.add_argument('--type',help='The kind of ingest action',choices=['data','urls','now', 'at'],default='data')
+   argparser.add_argument('--type',help='The kind of ingest action',choices=['data','urls','now', 'at', 's3', 'stream'],default='data')
+   argparser.add_argument('--metrics',help='Output a JSON summary of the metrics for each source and in total',action='store_true',default=False)
+   argparser.add_argument('--metrics-file',help='Write the total metrics to a Prometheus textfile')
+   argparser.add_argument('--expand-delta',help='Ingest every poll of delta-encoded partitions rather than only the changed readings',action='store_true',default=False)
    argparser.add_argument('--ignore-not-found',help='Ignore not found errors',action='store_true',default=False)
+   argparser.add_argument('--workers',help='The number of sources to download and ingest concurrently',type=int,default=1)
    argparser.add_argument('source',help='A list of files or urls of data to ingest (or - for stdin)',nargs='*')
 
    args = argparser.parse_args()
@@ -158,7 +937,10 @@ if __name__ == '__main__':
    if args.password is None and 'REDIS_PASSWORD' in os.environ:
       args.password = os.environ['REDIS_PASSWORD']
 
-   client = redis.Redis(host=args.host,port=args.port,password=args.password)
+   if args.cluster:
+      client = redis.RedisCluster(host=args.host,port=args.port,password=args.password)
+   else:
+      client = redis.Redis(host=args.host,port=args.port,password=args.password)
 
    box = None
    if args.bounding_box is not None:
@@ -175,6 +957,10 @@ if __name__ == '__main__':
       print('The partition {} is not a divisor of 60'.format(args.partition))
       sys.exit(1)
 
+   if args.key_prefix is None:
+      # binary members are kept apart from text members
+      args.key_prefix = 'AQI30B-' if args.encoding=='binary' else 'AQI30-'
+
    sources = args.source
    if len(args.source)==0 or (len(args.source)==1 and args.source[0]=='-'):
       sources = [sys.stdin]
@@ -196,10 +982,33 @@ if __name__ == '__main__':
      'box' : box,
      'partition' : args.partition,
      'prefix' : args.key_prefix,
-     'verbose' : args.verbose,
-     'confirm' : args.confirm
+     'group_size' : args.group_size,
+     'vectorized' : args.vectorized,
+     'aggregate' : args.aggregate,
+     'encoding' : args.encoding,
+     'shard_size' : args.shard_size,
+     'verbose' : args.verbose
    }
 
+   totals = IngestMetrics()
+   totals_lock = threading.Lock()
+   run_start = time()
+   def report(metrics):
+      with totals_lock:
+         totals.add(metrics)
+         if args.metrics:
+            print(metrics.json(),flush=True)
+   if not args.metrics and args.metrics_file is None:
+      report = None
+
+   def publish():
+      # the rate of the run is by wall-clock time as the sources may be ingested by several workers
+      totals.elapsed = time() - run_start
+      if args.metrics:
+         print(totals.json(),flush=True)
+      if args.metrics_file is not None:
+         totals.write_textfile(args.metrics_file)
+
    if args.type=='now':
       if args.bucket_url is None:
          print('You must provide a base URL for the bucket.',file=sys.stderr)
@@ -211,7 +1020,7 @@ if __name__ == '__main__':
       prev_timestamp = timestamp - timedelta(minutes=args.partition)
       prev_partition_no = prev_timestamp.minute // args.partition
       prev_partition_start = datetime(prev_timestamp.year,prev_timestamp.month,prev_timestamp.day,prev_timestamp.hour,prev_partition_no * args.partition,tzinfo=prev_timestamp.tzinfo)
-      sources = [args.bucket_url + partition_start.isoformat() + '.json', args.bucket_url + prev_partition_start.isoformat() + '.json']
+      sources = [args.bucket_url + partition_start.isoformat() + args.suffix, args.bucket_url + prev_partition_start.isoformat() + args.suffix]
       args.type = 'data'
 
    if args.type=='at':
@@ -222,52 +1031,81 @@ if __name__ == '__main__':
 
       sources = []
       for item in args.source:
-         sources += map(lambda timestamp : args.bucket_url + timestamp.isoformat() + '.json', date_range(item))
+         sources += map(lambda timestamp : args.bucket_url + timestamp.isoformat() + args.suffix, date_range(item))
       args.type = 'data'
 
 
-   if args.type=='data':
-      for source in sources:
-         if args.verbose or args.confirm:
-            print(source,flush=True)
-         if type(source)==str:
-            if os.path.isfile(source):
-               with open(source,'r') as input:
-                  data = json.load(input)
-                  ingest(client,data,**kwargs)
-            else:
-               resp = requests.get(source)
-               if resp.status_code==200:
-                  ingest(client,resp.json(),**kwargs)
+   # url lists and streams may name s3:// objects that are only known once they are read
+   s3 = None
+   s3_configured = args.s3_endpoint is not None or args.s3_key is not None or args.s3_secret is not None
+   if args.type in ['s3','urls','stream'] or s3_configured or (args.bucket_url is not None and args.bucket_url.startswith('s3://')) or any(type(source)==str and source.startswith('s3://') for source in sources):
+      s3 = create_s3_client(endpoint=args.s3_endpoint,key=args.s3_key,secret=args.s3_secret,pool_size=max(args.workers,10))
+
+   if args.type=='s3':
+
+      if args.bucket_url is None or not args.bucket_url.startswith('s3://'):
+         print('You must provide an s3://bucket/prefix url for the bucket.',file=sys.stderr)
+         sys.exit(1)
+
+      bucket, prefix = parse_s3_url(args.bucket_url)
+      try:
+         bounds = [date_bounds(item) for item in args.source] if len(args.source)>0 else [(None,None)]
+      except ValueError as ex:
+         print(str(ex),file=sys.stderr)
+         sys.exit(1)
+      def listed():
+         for start, end in bounds:
+            yield from s3_partitions(s3,bucket,prefix=prefix,start=start,end=end)
+      sources = listed()
+      args.type = 'data'
+
+   try:
+      if args.type=='stream':
+         for source in sources:
+            if type(source)==str:
+               if os.path.isfile(source):
+                  with open(source,'r') as input:
+                     ingest_stream(client,input,confirm=args.verbose or args.confirm,report=report,**kwargs)
+               elif source.startswith('s3://'):
+                  bucket, key = parse_s3_url(source)
+                  obj = s3.get_object(Bucket=bucket,Key=key)
+                  ingest_stream(client,obj['Body'].iter_lines(),confirm=args.verbose or args.confirm,report=report,**kwargs)
                else:
-                  if args.ignore_not_found and resp.status_code==404:
-                     print('{} not found'.format(source),file=sys.stderr)
-                     continue
-                  print('Error getting {}, status={}'.format(source,resp.status_code))
-                  print(resp.text)
-                  sys.exit(1)
-         else:
-            data = json.load(source)
-            ingest(client,data,**kwargs)
-
-   elif args.type=='urls':
-      for source in sources:
-         if args.verbose or args.confirm:
-            print(source,flush=True)
-         if type(source)==str:
-            if os.path.isfile(source):
-               with open(source,'r') as input:
-                  ingest_urls(input,client,**kwargs)
+                  with requests.get(source,stream=True) as resp:
+                     if resp.status_code!=200:
+                        raise SourceError(source,resp.status_code,resp.text)
+                     ingest_stream(client,resp.iter_lines(),confirm=args.verbose or args.confirm,report=report,**kwargs)
             else:
-               resp = requests.get(source)
-               if resp.status_code==200:
-                  ingest_urls(resp.text,client,**kwargs)
+               ingest_stream(client,source,confirm=args.verbose or args.confirm,report=report,**kwargs)
+
+      elif args.type=='data':
+         ingest_sources(client,sources,workers=args.workers,s3=s3,expand=args.expand_delta,ignore_not_found=args.ignore_not_found,confirm=args.verbose or args.confirm,report=report,**kwargs)
+
+      elif args.type=='urls':
+         for source in sources:
+            if args.verbose or args.confirm:
+               print(source,flush=True)
+            if type(source)==str:
+               if os.path.isfile(source):
+                  with open(source,'r') as input:
+                     ingest_urls(input,client,workers=args.workers,s3=s3,expand=args.expand_delta,ignore_not_found=args.ignore_not_found,confirm=args.confirm,report=report,**kwargs)
                else:
-                  if args.ignore_not_found and resp.status_code==404:
-                     print('{} not found'.format(source),file=sys.stderr)
-                     continue
-                  print('Error getting {}, status={}'.format(source,resp.status_code))
-                  print(resp.text)
-                  sys.exit(1)
-         else:
-            ingest_urls(source,client,**kwargs)
+                  resp = requests.get(source)
+                  if resp.status_code==200:
+                     ingest_urls(resp.text,client,workers=args.workers,s3=s3,expand=args.expand_delta,ignore_not_found=args.ignore_not_found,confirm=args.confirm,report=report,**kwargs)
+                  else:
+                     if args.ignore_not_found and resp.status_code==404:
+                        print('{} not found'.format(source),file=sys.stderr)
+                        continue
+                     print('Error getting {}, status={}'.format(source,resp.status_code))
+                     print(resp.text)
+                     sys.exit(1)
+            else:
+               ingest_urls(source,client,workers=args.workers,s3=s3,expand=args.expand_delta,ignore_not_found=args.ignore_not_found,confirm=args.confirm,report=report,**kwargs)
+   except SourceError as ex:
+      print(str(ex))
+      print(ex.text)
+      publish()
+      sys.exit(1)
+
+   publish()
@@ -1,4 +1,5 @@
 import sys
+import os
 import argparse
 import requests
 import json
@@ -8,6 +9,9 @@ import scipy.interpolate
 
 import pykrige
 
+from reader import read_chunks, decompress_chunks, partition_data, without_removed, removed_mask
+from columnar import ColumnarPartition, is_columnar, MAGIC
+
 
 
 # data format
@@ -129,28 +133,89 @@ def plot_grid(grid,colormap=None):
    plt.imshow(grid,cmap=plt.get_cmap(colormap) if colormap is not None else None)
    plt.show()
 
-def loader(box,urls,mesh_size=100,resolution=None,verbose=False):
+def row_readings(rows,verbose=False):
+   """
+   Iterates the (lat, lon, aqi) of the outdoor readings less than 30 minutes
+   old in the rows of a partition (without the header row).
+   """
+   for row in rows:
+      if row[2]<30 and row[11]==0:
+         aqi = list(map(lambda v : aqiFromPM(float(v)) if v is not None else 0,row[3:7]))
+         if row[13] is None or row[14] is None:
+            if verbose:
+               print('Ignoring: '+(','.join(map(str,[row[1],row[11],row[12],row[13],row[14]]))))
+            continue
+         yield float(row[13]), float(row[14]), aqi
+
+def columnar_readings(data,verbose=False):
+   """
+   A version of row_readings() for a columnar partition that selects the
+   readings with array operations.
+   """
+   fields = data.fields
+   age = np.array(data.column(fields[2]),dtype=float)
+   kind = np.array(data.column(fields[11]),dtype=float)
+   lat = np.array(data.column(fields[13]),dtype=float)
+   lon = np.array(data.column(fields[14]),dtype=float)
+   pm = np.array([data.column(fields[position]) for position in range(3,7)],dtype=float).T
+   located = ~np.isnan(lat) & ~np.isnan(lon)
+   selected = (age<30) & (kind==0)
+   readings = removed_mask(data)
+   if readings is not None:
+      selected &= readings
+   if verbose:
+      for position in np.flatnonzero(selected & ~located):
+         print('Ignoring: '+(','.join(map(str,[data.column(field,position,position+1)[0] for field in fields[11:15]]))))
+   for lat_value, lon_value, values in zip(lat[selected & located].tolist(),lon[selected & located].tolist(),pm[selected & located].tolist()):
+      yield lat_value, lon_value, [aqiFromPM(v) if v==v else 0 for v in values]
+
+def load_partition(source,allow_local=False):
+   """
+   Returns the partition data from an http(s) url or, when allow_local is
+   true, a local file: a ColumnarPartition for columnar partitions (memory
+   mapped for local files) or otherwise an iterator of the JSON rows. The
+   partition may be compressed.
+   """
+   if allow_local and os.path.isfile(source):
+      with open(source,'rb') as input:
+         columnar = is_columnar(input.read(len(MAGIC)))
+      if columnar:
+         return ColumnarPartition.open(source)
+      input = open(source,'rb')
+      data = partition_data(decompress_chunks(read_chunks(input)))
+      if isinstance(data,ColumnarPartition):
+         input.close()
+         return data
+      def rows():
+         try:
+            yield from data
+         finally:
+            input.close()
+      return rows()
+   if not source.startswith(('http://','https://')):
+      raise ValueError('Cannot load {}, only http and https urls are supported'.format(source))
+   resp = requests.get(source,stream=True)
+   if resp.status_code!=200:
+      raise ValueError('Cannot load {}, status {}'.format(source,str(resp.status_code)))
+   return partition_data(decompress_chunks(resp.iter_content(chunk_size=65536)))
+
+def loader(box,urls,mesh_size=100,resolution=None,allow_local=False,verbose=False):
    interpolator = AQIInterpolator(box,mesh_size=mesh_size,resolution=resolution)
 
    for url in urls:
-      resp = requests.get(url)
-      if resp.status_code==200:
-         data = resp.json()
-         headers = data[0]
-         count = 0
-         for row in data[1:]:
-            if row[2]<30 and row[11]==0:
-               aqi = list(map(lambda v : aqiFromPM(float(v)) if v is not None else 0,row[3:7]))
-               if row[13] is None or row[14] is None:
-                  if verbose:
-                     print('Ignoring: '+(','.join(map(str,[row[1],row[11],row[12],row[13],row[14]]))))
-                  continue
-               if interpolator.add(float(row[13]),float(row[14]),aqi):
-                  count += 1
-         if verbose:
-            print('Count: '+str(count))
+      data = load_partition(url,allow_local=allow_local)
+      if isinstance(data,ColumnarPartition):
+         readings = columnar_readings(data,verbose=verbose)
       else:
-         raise ValueError('Cannot load {}, status {}'.format(url,str(resp.status_code)))
+         data = without_removed(data)
+         headers = next(data,None)
+         readings = row_readings(data,verbose=verbose)
+      count = 0
+      for lat, lon, aqi in readings:
+         if interpolator.add(lat,lon,aqi):
+            count += 1
+      if verbose:
+         print('Count: '+str(count))
 
    return interpolator
 
@@ -179,7 +244,7 @@ if __name__ == '__main__':
    if args.verbose:
       print('Bounding box: '+(','.join(map(str,box))))
 
-   interpolator = loader(box,args.urls,mesh_size=args.size,resolution=args.resolution)
+   interpolator = loader(box,args.urls,mesh_size=args.size,resolution=args.resolution,allow_local=True)
 
    grid = interpolator.generate_grid(method=args.method,index=args.index)
 
@@ -14,7 +14,7 @@ if __name__ == '__main__':
    argparser.add_argument('--bucket-url',help='The bucket url prefix')
    argparser.add_argument('--endpoint',help='The endpoint url')
    argparser.add_argument('--bucket',help='The bucket name')
-   argparser.add_argument('--type',help='The kind of ingest action',choices=['data','urls','now', 'at'],default='data')
+   argparser.add_argument('--type',help='The kind of ingest action',choices=['data','urls','now', 'at', 'stream'],default='data')
    argparser.add_argument('--template',help='The job template.',default='ingest.yaml')
    argparser.add_argument('--container',help='The container',default='ingest')
    argparser.add_argument('--name',help='The job-name',default='ingest')
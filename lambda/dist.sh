@@ -14,6 +14,10 @@ cp /redis-aqi/app.py package
 cp /redis-aqi/geo.py package
 cp /redis-aqi/interpolate.py package
 cp /redis-aqi/ingest.py package
+cp /redis-aqi/members.py package
+cp /redis-aqi/reader.py package
+cp /redis-aqi/columnar.py package
+cp /redis-aqi/cache.py package
 cp -r /redis-aqi/templates package
 cp -r /redis-aqi/assets package
 find package -name __pycache__ -exec rm -rf {} \;
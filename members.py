@@ -0,0 +1,70 @@
+import struct
+from datetime import datetime
+
+# The encoding of the partition keys and the members of the geospatial sets
+# shared by ingest, rollup, and the application (without their dependencies).
+
+# support for python 3.6
+def fromisoformat(value):
+   if hasattr(datetime,'fromisoformat'):
+      return datetime.fromisoformat(value)
+   else:
+      if value.find('.')<0:
+         return datetime.strptime(value,'%Y-%m-%dT%H:%M:%S')
+      else:
+         return datetime.strptime(value,'%Y-%m-%dT%H:%M:%S.%f')
+
+def datetime_score(value):
+   return value.year*10**8 + value.month*10**6 + value.day*10**4 + value.hour*60 + value.minute
+
+MEMBER_VERSION = 1
+member_encodings = ['text','binary']
+
+# version (uint8), sensor id (uint32), offset (uint8)
+_member_header = struct.Struct('<BIB')
+
+def text_member(id, offset, pm):
+   return str(id) + '@' + str(offset) + ',' + ','.join(map(str,pm))
+
+def binary_member(id, offset, pm):
+   """
+   Encodes a reading as a versioned binary member: the version byte, the
+   sensor id, the offset, and each value as a little-endian uint16 scaled by
+   10 (i.e., a resolution of 0.1 clipped to [0,6553.5]).
+   """
+   values = [min(max(int(round(v*10)),0),65535) for v in pm]
+   return _member_header.pack(MEMBER_VERSION,int(id),offset) + struct.pack('<'+str(len(values))+'H',*values)
+
+def decode_member(member):
+   """
+   Decodes a text or binary member (bytes) into an (id, offset, values) tuple.
+   """
+   if member[0]==MEMBER_VERSION:
+      _, id, offset = _member_header.unpack_from(member)
+      count = (len(member) - _member_header.size) // 2
+      return str(id), offset, [value / 10 for value in struct.unpack_from('<'+str(count)+'H',member,_member_header.size)]
+   sensor = member.decode('utf-8').split(',')
+   id, offset = sensor[0].split('@')
+   return id, int(offset), list(map(float,sensor[1:]))
+
+def version_key(prefix='AQI30-'):
+   """
+   Returns the key of the hash of the version stamp of each partition key
+   (e.g., AQI30-versions). The version is incremented whenever members are
+   added to the partition so that cached query results can be invalidated.
+   """
+   return prefix + 'versions'
+
+def counts_key(key):
+   """
+   Returns the key of the hash of the number of readings aggregated for each
+   sensor of an aggregated partition (e.g., AQI30-2020-09-10T11:30:00PT30M/counts).
+   """
+   return key + '/counts'
+
+def shards_key(key):
+   """
+   Returns the key of the set of the shard keys of a partition ingested as
+   per-cell shards (e.g., AQI30-2020-09-10T11:30:00PT30M/shards).
+   """
+   return key + '/shards'
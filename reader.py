@@ -0,0 +1,201 @@
+import json
+import codecs
+import zlib
+from itertools import chain
+
+from columnar import ColumnarPartition, is_columnar, MAGIC
+
+# Reading partition files (JSON or columnar, uncompressed, gzip, or zstd)
+# from files, responses, or streams of chunks.
+
+def read_chunks(input,chunk_size=65536):
+   while True:
+      chunk = input.read(chunk_size)
+      if not chunk:
+         return
+      yield chunk
+
+# the suffixes of the partition files (JSON or columnar, uncompressed, gzip, or zstd)
+partition_suffixes = ['.json','.json.gz','.json.zst','.aqc','.aqc.gz','.aqc.zst']
+
+_gzip_magic = b'\x1f\x8b'
+_zstd_magic = b'\x28\xb5\x2f\xfd'
+
+def decompress_chunks(chunks):
+   """
+   Detects gzip or zstd compressed content by its magic number and
+   decompresses the chunks as they are read. Any other content is passed
+   through unchanged. The zstd format requires the zstandard package.
+   """
+   chunks = iter(chunks)
+   first = b''
+   for first in chunks:
+      if len(first)>0:
+         break
+   if len(first)==0:
+      return
+   if isinstance(first,str) or not (first.startswith(_gzip_magic) or first.startswith(_zstd_magic)):
+      yield first
+      yield from chunks
+      return
+
+   if first.startswith(_gzip_magic):
+      def decompressor():
+         return zlib.decompressobj(wbits=zlib.MAX_WBITS|16)
+   else:
+      import zstandard
+      def decompressor():
+         return zstandard.ZstdDecompressor().decompressobj()
+
+   current = decompressor()
+   for chunk in chain([first],chunks):
+      while len(chunk)>0:
+         data = current.decompress(chunk)
+         if len(data)>0:
+            yield data
+         chunk = b''
+         if current.eof:
+            # concatenated members or frames
+            chunk = current.unused_data
+            current = decompressor()
+   data = current.flush()
+   if len(data)>0:
+      yield data
+
+def partition_name(name):
+   """
+   Returns the name of a partition file without its suffix or None if the
+   name does not have a partition suffix.
+   """
+   for suffix in partition_suffixes:
+      if name.endswith(suffix):
+         return name[:-len(suffix)]
+   return None
+
+def partition_data(chunks):
+   """
+   Returns a ColumnarPartition for columnar content or otherwise iterates
+   the rows of the JSON partition.
+   """
+   chunks = iter(chunks)
+   first = None
+   for chunk in chunks:
+      first = chunk if first is None else first + chunk
+      if isinstance(first,str) or len(first)>=len(MAGIC):
+         break
+   if first is None:
+      return json_rows([])
+   if isinstance(first,bytes) and is_columnar(first):
+      return ColumnarPartition(b''.join(chain([first],chunks)))
+   return json_rows(chain([first],chunks))
+
+def without_removed(rows):
+   """
+   Iterates the rows of a partition (the header row first) without the rows
+   of a delta-encoded partition (collect.py --delta) that mark a sensor that
+   is no longer reported ('R') or a poll without changes ('N') as they are
+   not readings. Other partitions are passed through unchanged.
+   """
+   rows = iter(rows)
+   header = next(rows,None)
+   if header is None:
+      return
+   yield header
+   if header[-1]!='delta':
+      yield from rows
+      return
+   for row in rows:
+      if row[-1]!='R' and row[-1]!='N':
+         yield row
+
+def removed_mask(data,start=0,end=None):
+   """
+   Returns a boolean array of the rows [start,end) of a columnar partition
+   that are readings (see without_removed) or None when the partition is
+   not delta-encoded.
+   """
+   if data.fields[-1]!='delta':
+      return None
+   markers = data.column('delta',start,end)
+   return (markers!='R') & (markers!='N')
+
+_json_whitespace = ' \t\r\n'
+_json_delimiters = _json_whitespace + ',]'
+# a truncated item fails to decode within the last few characters of the buffer (e.g., 'tru' or '\\ud83d\\ude0')
+_json_truncated = 12
+
+def json_rows(source,chunk_size=65536):
+   """
+   Iterates the items of a top-level JSON array (e.g., the rows of a partition
+   file) incrementally without loading the whole document.
+
+   Arguments:
+   source - a file-like object (text or binary) or an iterable of str/bytes chunks (e.g., resp.iter_content())
+   chunk_size - the size of the reads from a file-like object
+   """
+   chunks = read_chunks(source,chunk_size=chunk_size) if hasattr(source,'read') else iter(source)
+
+   utf8 = codecs.getincrementaldecoder('utf-8')()
+   def more():
+      for chunk in chunks:
+         text = utf8.decode(chunk) if isinstance(chunk,bytes) else chunk
+         if len(text)>0:
+            return text
+      return None
+
+   decoder = json.JSONDecoder()
+   buffer = ''
+   pos = 0
+   opened = False
+   separator = False
+   while True:
+      while pos < len(buffer) and buffer[pos] in _json_whitespace:
+         pos += 1
+      if pos == len(buffer):
+         buffer = more()
+         pos = 0
+         if buffer is None:
+            raise ValueError('Unexpected end of JSON array')
+         continue
+
+      c = buffer[pos]
+      if not opened:
+         if c != '[':
+            raise ValueError('Expected a JSON array, found: '+c)
+         opened = True
+         pos += 1
+         continue
+      if c == ']':
+         return
+      if separator:
+         if c != ',':
+            raise ValueError('Expected , between array items, found: '+c)
+         separator = False
+         pos += 1
+         continue
+
+      try:
+         value, end = decoder.raw_decode(buffer,pos)
+      except json.JSONDecodeError as e:
+         # an error before the end of the buffer is malformed JSON rather than an incomplete item
+         if len(buffer) - e.pos > _json_truncated and not e.msg.startswith('Unterminated string'):
+            raise
+         # the item is incomplete; read more data
+         text = more()
+         if text is None:
+            raise
+         buffer = buffer[pos:] + text
+         pos = 0
+         continue
+
+      if not isinstance(value,(list,dict,str)) and (end == len(buffer) or buffer[end] not in _json_delimiters):
+         # a literal at the end of the buffer may be truncated
+         text = more()
+         if text is not None:
+            buffer = buffer[pos:] + text
+            pos = 0
+            continue
+
+      yield value
+      pos = end
+      separator = True
@@ -0,0 +1,193 @@
+import redis
+import sys
+import os
+import argparse
+from datetime import datetime, timedelta
+
+from ingest import accumulate, aggregated_members, aggregated_counts, write_counts, aggregate_methods
+from members import fromisoformat, datetime_score, decode_member, member_encodings, version_key, counts_key, shards_key
+from geo import sequence_number, shard_key
+
+# the rollup durations from finest to coarsest
+rollup_durations = ['PT1H','P1D']
+
+def window_start(t,duration):
+   if duration=='P1D':
+      return datetime(t.year,t.month,t.day,tzinfo=t.tzinfo)
+   return datetime(t.year,t.month,t.day,t.hour,tzinfo=t.tzinfo)
+
+def window_offset(t,start,duration):
+   # minutes into the hour or hours into the day
+   return int((t - start).total_seconds() // (3600 if duration=='P1D' else 60))
+
+def partition_keys(client,prefix='AQI30-',duration='PT30M',before=None):
+   """
+   Iterates the (key, start) of the partitions registered in the partition
+   set for the duration that start before the given datetime.
+   """
+   partition_set = prefix + duration
+   max_score = '(' + str(datetime_score(before)) if before is not None else '+inf'
+   for key in client.zrangebyscore(partition_set,'-inf',max_score):
+      key = key.decode('utf-8')
+      yield key, fromisoformat(key[len(prefix):key.rfind('P')])
+
+def partition_members(client,key,batch_size=1000):
+   """
+   Iterates all the (member, (lat,lon)) values of a geospatial key.
+   """
+   start = 0
+   while True:
+      batch = client.zrange(key,start,start + batch_size - 1)
+      if len(batch)==0:
+         return
+      for member, pos in zip(batch,client.geopos(key,*batch)):
+         if pos is not None:
+            yield member, (pos[1], pos[0])
+      start += batch_size
+
+def source_keys(client,key,shard_size=None):
+   if shard_size is None:
+      return [key]
+   prefix = key + '/' + str(float(shard_size)) + '/'
+   # the shards registered at ingest (see members.shards_key)
+   shards = [shard.decode('utf-8') for shard in client.smembers(shards_key(key))]
+   if len(shards)==0:
+      # a partition ingested before the shards were registered
+      return [shard.decode('utf-8') for shard in client.scan_iter(match=prefix + '*')]
+   return sorted(shard for shard in shards if shard.startswith(prefix))
+
+def rollup(client,before,prefix='AQI30-',partition=30,durations=rollup_durations,method='mean',precision=None,encoding='text',shard_size=None,expire=0,keep=False,group_size=500,verbose=False):
+   """
+   Compacts the partitions that start before a datetime into coarser
+   partitions for each of the durations (PT1H, P1D). Each sensor has a
+   single member per coarse partition that aggregates its readings (see
+   ingest.aggregate_rows) where the offset is in minutes for PT1H and hours
+   for P1D and the number of readings is in the counts hash of the coarse
+   partition (see members.counts_key). The coarse partitions are registered in their own partition sets
+   (e.g., AQI30-PT1H).
+
+   Only whole windows of the coarsest duration are compacted. The raw
+   partitions are removed from their partition set and, unless keep is
+   true, expire after the given number of seconds (0 removes them
+   immediately).
+
+   Returns the number of raw partitions compacted.
+   """
+   for duration in durations:
+      if duration not in rollup_durations:
+         raise ValueError('Unsupported rollup duration: '+duration)
+   if method not in aggregate_methods:
+      raise ValueError('Unknown aggregation method: '+str(method))
+
+   raw_duration = 'PT' + str(partition) + 'M'
+   coarsest = 'P1D' if 'P1D' in durations else 'PT1H'
+   threshold = window_start(before,coarsest)
+
+   # group the raw partitions by the coarsest window so each window is complete
+   windows = {}
+   for key, start in partition_keys(client,prefix=prefix,duration=raw_duration,before=threshold):
+      windows.setdefault(window_start(start,coarsest),[]).append((key,start))
+
+   count = 0
+   for window in sorted(windows.keys()):
+      raw = windows[window]
+      if verbose:
+         print('{window} : {count} partitions'.format(window=window.isoformat(),count=len(raw)),flush=True)
+
+      # (rollup key, id) -> [start, lon, lat, offset, pm, count]
+      sensors = {}
+      raw_keys = []
+      for key, start in raw:
+         for source in source_keys(client,key,shard_size=shard_size):
+            raw_keys.append(source)
+            for member, (lat, lon) in partition_members(client,source):
+               id, offset, values = decode_member(member)
+               t = start + timedelta(minutes=offset)
+               for duration in durations:
+                  w = window_start(t,duration)
+                  accumulate(sensors,(prefix + w.isoformat() + duration,id),w,lon,lat,window_offset(t,w,duration),values,method=method)
+
+      pipe = client.pipeline(transaction=False)
+      groups = {}
+      scores = {}
+      for key, start, lon, lat, member in aggregated_members(sensors,method=method,precision=precision,encoding=encoding):
+         scores[key] = datetime_score(start)
+         target = key if shard_size is None else shard_key(key,shard_size,sequence_number(shard_size,(lat,lon)))
+         if target not in groups and target != key:
+            pipe.sadd(shards_key(key),target)
+         group = groups.setdefault(target,[])
+         group.extend((lon,lat,member))
+         if len(group) >= group_size*3:
+            pipe.execute_command('GEOADD',target,*group)
+            group.clear()
+      for target, group in groups.items():
+         if len(group)>0:
+            pipe.execute_command('GEOADD',target,*group)
+      write_counts(pipe,aggregated_counts(sensors))
+      for key, score in scores.items():
+         # prefix + duration (e.g., AQI30-PT1H)
+         pipe.zadd(prefix + key[key.rfind('P'):],{key : score})
+         pipe.hincrby(version_key(prefix),key,1)
+      pipe.execute()
+
+      pipe = client.pipeline(transaction=False)
+      pipe.zrem(prefix + raw_duration,*[key for key, _ in raw])
+      if not keep:
+         for key in raw_keys + [counts_key(key) for key, _ in raw] + [shards_key(key) for key, _ in raw]:
+            if expire>0:
+               pipe.expire(key,expire)
+            else:
+               pipe.unlink(key)
+      # the compacted partitions are no longer cached (see cache.PartitionCache) and their versions are removed
+      pipe.hdel(version_key(prefix),*[key for key, _ in raw])
+      pipe.execute()
+      count += len(raw)
+
+   return count
+
+if __name__ == '__main__':
+
+   argparser = argparse.ArgumentParser(description='rollup')
+   argparser.add_argument('--host',help='Redis host',default='0.0.0.0')
+   argparser.add_argument('--port',help='Redis port',type=int,default=6379)
+   argparser.add_argument('--password',help='Redis password')
+   argparser.add_argument('--cluster',help='Connect to a Redis Cluster',action='store_true',default=False)
+   argparser.add_argument('--verbose',help='Verbose output',action='store_true',default=False)
+   argparser.add_argument('--key-prefix',help='The key prefix.',default='AQI30-')
+   argparser.add_argument('--partition',help='The time partition (in minutes, must be a divisor of 60)',default=30,type=int)
+   argparser.add_argument('--older-than',help='Compact partitions older than this number of days',type=float,default=7)
+   argparser.add_argument('--durations',help='The rollup durations (comma separated list of PT1H, P1D)',default='PT1H,P1D')
+   argparser.add_argument('--method',help='The aggregation of the sensor readings',choices=aggregate_methods,default='mean')
+   argparser.add_argument('--precision',help='Round the aggregated measurements to the precision',type=int)
+   argparser.add_argument('--encoding',help='The member encoding',choices=member_encodings,default='text')
+   argparser.add_argument('--shard-size',help='The shard quadrangle size used at ingest',type=float)
+   argparser.add_argument('--expire',help='The number of seconds until the compacted partitions expire (0 removes them immediately)',type=int,default=0)
+   argparser.add_argument('--keep',help='Keep the compacted partitions',action='store_true',default=False)
+
+   args = argparser.parse_args()
+
+   if args.password is None and 'REDIS_PASSWORD' in os.environ:
+      args.password = os.environ['REDIS_PASSWORD']
+
+   if 60 % args.partition:
+      print('The partition {} is not a divisor of 60'.format(args.partition))
+      sys.exit(1)
+
+   durations = args.durations.split(',')
+   for duration in durations:
+      if duration not in rollup_durations:
+         print('Unsupported rollup duration: '+duration,file=sys.stderr)
+         sys.exit(1)
+   durations = [duration for duration in rollup_durations if duration in durations]
+
+   if args.cluster:
+      client = redis.RedisCluster(host=args.host,port=args.port,password=args.password)
+   else:
+      client = redis.Redis(host=args.host,port=args.port,password=args.password)
+
+   before = datetime.utcnow() - timedelta(days=args.older_than)
+
+   count = rollup(client,before,prefix=args.key_prefix,partition=args.partition,durations=durations,method=args.method,precision=args.precision,encoding=args.encoding,shard_size=args.shard_size,expire=args.expire,keep=args.keep,verbose=args.verbose)
+
+   if args.verbose:
+      print('{} partitions compacted'.format(count))
@@ -0,0 +1,51 @@
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from geo import sequence_numbers, shard_key, query_shards, query_partitions
+from members import datetime_score
+
+try:
+   import fakeredis
+except ImportError:
+   fakeredis = None
+
+@unittest.skipIf(fakeredis is None,'requires fakeredis')
+class ShardEdgeTest(unittest.TestCase):
+   """
+   The sensors on the edges of the shard cells are returned by the sharded
+   queries (Redis stores them just outside of the cell of their shard).
+   """
+
+   key = 'AQI30-2020-09-10T11:30:00PT30M'
+   nw = (37.9,-122.4)
+   se = (36.1,-120.6)
+
+   def setUp(self):
+      self.client = fakeredis.FakeRedis()
+      # a grid of points where every fourth row and column is on a cell edge
+      lat, lon = [values.ravel() for values in np.meshgrid(np.arange(36.0,38.01,0.125),np.arange(-122.5,-120.49,0.125))]
+      for index, (lat_value, lon_value, number) in enumerate(zip(lat.tolist(),lon.tolist(),sequence_numbers(0.5,lat,lon).tolist())):
+         self.client.geoadd(shard_key(self.key,0.5,number),(lon_value,lat_value,'sensor-{}'.format(index)))
+      self.client.zadd('AQI30-PT30M',{self.key : datetime_score(datetime(2020,9,10,11,30))})
+
+      # the members stored in the shards that fall within the quadrangle
+      self.expected = set()
+      for shard in self.client.keys(self.key + '/0.5/*'):
+         for member, (lon_value, lat_value) in self.client.georadius(shard,-121.5,37.0,1000,unit='km',withcoord=True):
+            if self.nw[0] > lat_value > self.se[0] and self.nw[1] < lon_value < self.se[1]:
+               self.expected.add(member)
+
+   def test_query_shards(self):
+      members = [member for member, _ in query_shards(self.client,self.key,0.5,self.nw,self.se,by_box=False)]
+      self.assertEqual(len(members),len(self.expected))
+      self.assertEqual(set(members),self.expected)
+
+   def test_query_partitions(self):
+      results = list(query_partitions(self.client,'AQI30-',datetime(2020,9,10),datetime(2020,9,11),self.nw,self.se,shard_size=0.5,by_box=False))
+      self.assertEqual([partition for partition, _ in results],['2020-09-10T11:30:00PT30M'])
+      self.assertEqual(set(member for member, _ in results[0][1]),self.expected)
+
+if __name__ == '__main__':
+   unittest.main()